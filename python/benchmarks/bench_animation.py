@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# Frame rate the animation engine sustains against simulated devices.
+#
+# With the package installed (python3 -m pip install -e .)
+# > python3 benchmarks/bench_animation.py
+# > python3 benchmarks/bench_animation.py --devices 4 --fps 60 --write-latency 1
+# > python3 benchmarks/bench_animation.py --devices 4 --slow 1 --slow-latency 40
+import argparse
+import time
+
+from qmk_hid import animation, protocol
+
+from fake_hid import FakeHid
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the animation engine against simulated devices')
+    parser.add_argument('--devices', type=int, default=4, help='number of simulated devices')
+    parser.add_argument('--fps', type=int, default=animation.FPS, help='target frame rate')
+    parser.add_argument('--seconds', type=float, default=3.0, help='how long to animate')
+    parser.add_argument('--latency', type=float, default=1.0, help='device response latency in ms')
+    parser.add_argument('--write-latency', type=float, default=1.0, help='time a write blocks in ms')
+    parser.add_argument('--slow', type=int, default=0, help='how many of the devices are slow')
+    parser.add_argument('--slow-latency', type=float, default=40.0, help='write latency of slow devices in ms')
+    args = parser.parse_args()
+
+    fake = FakeHid(devices=args.devices, latency=args.latency / 1000, write_latency=args.write_latency / 1000)
+    protocol.hid = fake
+    devices = protocol.find_devs(show=False, verbose=False)
+    slow_paths = {dev['path'] for dev in devices[:args.slow]}
+
+    # Slow devices block longer on every write
+    device = fake.device
+
+    def make_device():
+        dev = device()
+        open_path = dev.open_path
+        write = dev.write
+
+        def slow_write(data):
+            if dev.path in slow_paths:
+                time.sleep(args.slow_latency / 1000)
+            return write(data)
+
+        def slow_open(path):
+            open_path(path)
+            if path in slow_paths:
+                dev.write = slow_write
+        dev.open_path = slow_open
+        return dev
+    fake.device = make_device
+
+    print("NumPy: {}".format("yes" if animation.np is not None else "no"))
+    animator = animation.Animator(devices, animation.Gradient(speed=256), fps=args.fps)
+    reports = fake.reports
+    animator.start()
+    time.sleep(args.seconds)
+    animator.stop()
+    stats = animator.stats()
+
+    print("{:.1f} frames/s rendered, {} skipped, {:.0f} reports/s".format(
+        stats['frames'] / args.seconds, stats['skipped'], (fake.reports - reports) / args.seconds))
+    for (path, s) in stats['devices'].items():
+        print("  {:<14} {:6.1f} frames/s sent  {:5} dropped  {:3} errors  now at {:.1f} fps{}".format(
+            path.decode(), s['sent'] / args.seconds, s['dropped'], s['errors'], s['fps'],
+            "  (slow)" if path in slow_paths else ""))
+
+
+if __name__ == "__main__":
+    main()
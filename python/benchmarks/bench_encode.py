@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Per-report overhead of encoding and sending, without any real device.
+#
+# With the package installed (python3 -m pip install -e .)
+# > python3 benchmarks/bench_encode.py
+import timeit
+
+from qmk_hid import protocol
+from qmk_hid.protocol import (
+    CUSTOM_GET_VALUE, CUSTOM_SET_VALUE, CHANNEL_RGB_MATRIX,
+    RGB_MATRIX_VALUE_COLOR, RAW_HID_BUFFER_SIZE,
+)
+
+N = 200000
+
+
+# How reports were encoded before, a new list for every report
+def encode_message_list(message_id, msg):
+    data = [0xFE] * RAW_HID_BUFFER_SIZE
+    data[0] = 0x00
+    data[1] = message_id
+    if msg:
+        for i, x in enumerate(msg):
+            data[2+i] = x
+    return data
+
+
+# Takes reports and answers reads instantly, like an infinitely fast device
+class NullHandle:
+    def __init__(self):
+        self.last = b""
+
+    def write(self, data):
+        # hidapi converts whatever it gets to bytes
+        self.last = bytes(data)
+        return len(data)
+
+    def read(self, max_length, timeout_ms=0):
+        if not timeout_ms:
+            return []
+        return list(self.last[1:1+max_length])
+
+    def close(self):
+        pass
+
+
+def bench(name, fn):
+    secs = min(timeit.repeat(fn, number=N, repeat=3))
+    print(f"{name:<40} {secs / N * 1e9:8.0f} ns/report")
+
+
+def main():
+    msg = [CHANNEL_RGB_MATRIX, RGB_MATRIX_VALUE_COLOR, 85, 255]
+    buf = bytearray(RAW_HID_BUFFER_SIZE)
+    assert bytes(protocol.encode_message(CUSTOM_SET_VALUE, msg, buf)) == bytes(encode_message_list(CUSTOM_SET_VALUE, msg))
+
+    # Including the conversion to bytes that hidapi does on write
+    bench("encode, new list per report", lambda: bytes(encode_message_list(CUSTOM_SET_VALUE, msg)))
+    bench("encode, reused bytearray", lambda: bytes(protocol.encode_message(CUSTOM_SET_VALUE, msg, buf)))
+
+    # Every report should actually be sent
+    protocol.STATE_CACHE = False
+    dev = {'path': b'bench'}
+    protocol._handles[dev['path']] = NullHandle()
+    get_msg = [CHANNEL_RGB_MATRIX, RGB_MATRIX_VALUE_COLOR]
+    bench("send_message, set", lambda: protocol.send_message(dev, CUSTOM_SET_VALUE, msg, 0))
+    bench("send_message, get", lambda: protocol.send_message(dev, CUSTOM_GET_VALUE, get_msg, 2))
+    protocol.close_device(dev)
+
+
+if __name__ == "__main__":
+    main()
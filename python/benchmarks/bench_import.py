@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# Startup cost of importing the qmk_hid modules, using python -X importtime.
+# Every module is imported in a fresh interpreter, best of several runs.
+#
+# With the package installed (python3 -m pip install -e .)
+# > python3 benchmarks/bench_import.py
+# > python3 benchmarks/bench_import.py qmk_hid.gui --top 15
+import argparse
+import re
+import subprocess
+import sys
+
+MODULES = [
+    "qmk_hid.protocol",
+    "qmk_hid.firmware_update",
+    "qmk_hid.uf2conv",
+    "qmk_hid.cli",
+    "qmk_hid.gui",
+]
+
+# import time: self [us] | cumulative | imported package
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)")
+
+
+def import_times(module):
+    """{module: (self us, cumulative us)} of importing module once"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, check=True,
+    )
+    times = {}
+    for line in proc.stderr.decode().splitlines():
+        m = LINE.match(line)
+        if m:
+            times[m.group(4)] = (int(m.group(1)), int(m.group(2)))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure import time of qmk_hid modules')
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=0, help='also show the N most expensive dependencies')
+    args = parser.parse_args()
+
+    for module in args.modules:
+        runs = [import_times(module) for _ in range(args.runs)]
+        best = min(runs, key=lambda times: times[module][1])
+        print("{:<28} {:8.1f}ms  {:3} modules".format(module, best[module][1] / 1000, len(best)))
+        if args.top:
+            by_self = sorted(best.items(), key=lambda item: item[1][0], reverse=True)
+            for (name, (self_us, _)) in by_self[:args.top]:
+                print("    {:<40} {:8.1f}ms".format(name, self_us / 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# Latency and throughput of qmk_hid.protocol against simulated devices.
+#
+# With the package installed (python3 -m pip install -e .)
+# > python3 benchmarks/bench_protocol.py
+# > python3 benchmarks/bench_protocol.py --latency 2 --jitter 1 --drop 0.01 --devices 4
+# > python3 benchmarks/bench_protocol.py --unpooled --no-cache
+import argparse
+import time
+import tracemalloc
+
+from qmk_hid import protocol
+from qmk_hid.executor import DeviceExecutor
+from qmk_hid.protocol import RGB_MATRIX_VALUE_BRIGHTNESS, GREEN_HUE
+
+from fake_hid import FakeHid
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def bench(fake, name, calls, fn, unpooled):
+    latencies = []
+    errors = 0
+    (opens, reports) = (fake.opens, fake.reports)
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(calls):
+        t = time.perf_counter()
+        try:
+            fn(i)
+        except protocol.QmkHidError:
+            errors += 1
+        latencies.append(time.perf_counter() - t)
+        if unpooled:
+            # Like before handles were pooled, a new open for every call
+            protocol.close_all_devices()
+    total = time.perf_counter() - start
+    (_current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print("{:<16} p50 {:8.3f}ms  p99 {:8.3f}ms  {:8.0f} calls/s  {:8.0f} reports/s  {:7.0f} opens/s  {:6.1f}KiB peak  {} errors".format(
+        name,
+        percentile(latencies, 50) * 1000,
+        percentile(latencies, 99) * 1000,
+        calls / total,
+        (fake.reports - reports) / total,
+        (fake.opens - opens) / total,
+        peak / 1024,
+        errors,
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark qmk_hid.protocol against simulated devices')
+    parser.add_argument('--calls', type=int, default=500, help='calls per benchmark')
+    parser.add_argument('--devices', type=int, default=4, help='number of simulated devices')
+    parser.add_argument('--latency', type=float, default=1.0, help='device response latency in ms')
+    parser.add_argument('--write-latency', type=float, default=1.0, help='time a write blocks in ms')
+    parser.add_argument('--jitter', type=float, default=0.0, help='+- jitter of the latency in ms')
+    parser.add_argument('--drop', type=float, default=0.0, help='fraction of responses that get lost')
+    parser.add_argument('--timeout', type=int, default=protocol.READ_TIMEOUT_MS, help='read timeout in ms')
+    parser.add_argument('--unpooled', action='store_true', help='reopen devices for every call')
+    parser.add_argument('--no-cache', action='store_true', help='disable the device state cache')
+    args = parser.parse_args()
+
+    fake = FakeHid(
+        devices=args.devices,
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        drop_rate=args.drop,
+        write_latency=args.write_latency / 1000,
+    )
+    protocol.hid = fake
+    protocol.READ_TIMEOUT_MS = args.timeout
+    protocol.STATE_CACHE = not args.no_cache
+
+    devices = protocol.find_devs(show=False, verbose=False)
+    dev = devices[0]
+    executor = DeviceExecutor()
+
+    bench(fake, "set_rgb_u8", args.calls, lambda i: protocol.set_rgb_u8(dev, RGB_MATRIX_VALUE_BRIGHTNESS, i % 256), args.unpooled)
+    bench(fake, "get_rgb_u8", args.calls, lambda i: protocol.get_rgb_u8(dev, RGB_MATRIX_VALUE_BRIGHTNESS), args.unpooled)
+    bench(fake, "set_rgb_color", args.calls, lambda i: protocol.set_rgb_color(dev, None, i % 256), args.unpooled)
+    bench(fake, "set_rgb_color+h", args.calls, lambda i: protocol.set_rgb_color(dev, GREEN_HUE, i % 256), args.unpooled)
+    bench(fake, "save", args.calls, lambda i: protocol.save(dev), args.unpooled)
+    bench(fake, "find_devs", max(1, args.calls // 10), lambda i: protocol.find_devs(show=False, verbose=False), args.unpooled)
+
+    def sequential(i):
+        for d in devices:
+            protocol.set_white_rgb_brightness(d, i % 256)
+
+    def fan_out(i):
+        for r in executor.run(devices, protocol.set_white_rgb_brightness, i % 256):
+            if r.error:
+                raise r.error
+
+    bench(fake, "sequential x{}".format(len(devices)), args.calls, sequential, args.unpooled)
+    bench(fake, "fan-out x{}".format(len(devices)), args.calls, fan_out, args.unpooled)
+    executor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
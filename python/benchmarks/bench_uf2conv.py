@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# Throughput and peak memory of the uf2conv conversions on synthetic images.
+#
+# With the package installed (python3 -m pip install -e .)
+# > python3 benchmarks/bench_uf2conv.py
+# > python3 benchmarks/bench_uf2conv.py --size 16 --runs 5
+# > python3 benchmarks/bench_uf2conv.py --hex .build/framework_ansi_default.hex
+import argparse
+import contextlib
+import io
+import mmap
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from qmk_hid import uf2conv
+
+
+def make_hex(data, base):
+    """Intel HEX with 16 byte data records and extended linear address records"""
+    lines = []
+    upper = None
+    for ptr in range(0, len(data), 16):
+        addr = base + ptr
+        if (addr >> 16) != upper:
+            upper = addr >> 16
+            rec = bytes([2, 0, 0, 4, upper >> 8, upper & 0xff])
+            lines.append(":" + (rec + bytes([-sum(rec) & 0xff])).hex().upper())
+        chunk = data[ptr:ptr + 16]
+        rec = bytes([len(chunk), (addr >> 8) & 0xff, addr & 0xff, 0]) + chunk
+        lines.append(":" + (rec + bytes([-sum(rec) & 0xff])).hex().upper())
+    lines.append(":00000001FF")
+    return ("\n".join(lines) + "\n").encode()
+
+
+def bench(name, runs, size, fn):
+    # uf2conv prints progress, keep it out of the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        # Separate run, tracemalloc slows down allocations a lot
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    best = min(times)
+    print("{:<24} {:9.1f}ms  {:8.1f}MiB/s  {:8.1f}MiB peak".format(
+        name, best * 1000, size / best / 1024 / 1024, peak / 1024 / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark uf2conv conversions')
+    parser.add_argument('--size', type=float, default=4, help='image size in MiB')
+    parser.add_argument('--runs', type=int, default=3, help='best of this many runs')
+    parser.add_argument('--hex', metavar='FILE', help='HEX file to convert instead of a synthetic one')
+    args = parser.parse_args()
+
+    data = random.Random(0).randbytes(int(args.size * 1024 * 1024)) \
+        if hasattr(random.Random, 'randbytes') else os.urandom(int(args.size * 1024 * 1024))
+    if args.hex:
+        with open(args.hex, 'rb') as f:
+            hex_buf = f.read()
+    else:
+        hex_buf = make_hex(data, 0x10000000)
+    uf2conv.appstartaddr = 0x10000000
+    uf2conv.familyid = 0xe48bff56
+
+    with open(os.devnull, 'wb') as devnull:
+        bench("bin -> uf2", args.runs, len(data), lambda: uf2conv.convert_to_uf2(data))
+        bench("bin -> uf2 (stream)", args.runs, len(data), lambda: uf2conv.convert_to_uf2(data, out=devnull))
+        bench("bin -> carray", args.runs, len(data), lambda: uf2conv.convert_to_carray(data))
+        bench("bin -> carray (stream)", args.runs, len(data), lambda: uf2conv.convert_to_carray(data, out=devnull))
+        bench("hex -> uf2", args.runs, len(hex_buf), lambda: uf2conv.convert_from_hex_to_uf2(hex_buf))
+        bench("hex -> uf2 (stream)", args.runs, len(hex_buf),
+              lambda: uf2conv.convert_from_hex_to_uf2(io.BytesIO(hex_buf), out=devnull))
+
+    uf2_buf = uf2conv.convert_to_uf2(data)
+    with tempfile.TemporaryFile() as f:
+        f.write(uf2_buf)
+        f.flush()
+        uf2_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        bench("uf2 -> bin", args.runs, len(uf2_buf), lambda: uf2conv.convert_from_uf2(uf2_map))
+        bench("uf2 summary", args.runs, len(uf2_buf), lambda: uf2conv.summarize_uf2(uf2_map))
+        uf2_map.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# In-process stand-in for the hid module, emulating QMK keyboards with VIA
+# custom value channels. Lets the benchmarks run without any hardware.
+#
+# Writes block for write_latency seconds, like waiting for the USB interrupt
+# transfer. Every report is answered after latency +- jitter seconds,
+# processed in order like on the real device. With drop_rate a fraction of
+# responses never arrives. Custom values of the channels in unsupported are
+# answered with 0xFF, like the RGB channel of the white backlight keyboard.
+import random
+import threading
+import time
+
+from qmk_hid.protocol import (
+    FWK_VID, QMK_INTERFACE, RAW_HID_BUFFER_SIZE,
+    CUSTOM_GET_VALUE, CUSTOM_SET_VALUE,
+)
+
+
+class FakeHid:
+    def __init__(self, devices=1, latency=0.001, jitter=0.0, drop_rate=0.0, write_latency=0.001, enumerate_latency=0.005, seed=0, unsupported=()):
+        self.latency = latency
+        self.unsupported = set(unsupported)
+        self.write_latency = write_latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.enumerate_latency = enumerate_latency
+        self.random = random.Random(seed)
+        self.opens = 0
+        self.reports = 0
+        self.enumerations = 0
+        self.lock = threading.Lock()
+        # Custom values of each device: {(channel, value id): [data, ...]}
+        self.state = {}
+        self.infos = []
+        for i in range(devices):
+            path = "/dev/hidraw{}".format(i).encode()
+            self.state[path] = {}
+            self.infos.append({
+                'path': path,
+                'vendor_id': FWK_VID,
+                'product_id': 0x12,
+                'serial_number': "FRAKDEBENCH{:04}".format(i),
+                'release_number': 0x0214,
+                'manufacturer_string': "Framework",
+                'product_string': "Laptop 16 Keyboard Module - ANSI",
+                'usage_page': 0xFF60,
+                'usage': 0x61,
+                'interface_number': QMK_INTERFACE,
+            })
+
+    # hid.enumerate
+    def enumerate(self, vendor_id=0, product_id=0):
+        with self.lock:
+            self.enumerations += 1
+        time.sleep(self.enumerate_latency)
+        return [dict(info) for info in self.infos if vendor_id in (0, info['vendor_id'])]
+
+    # hid.device
+    def device(self):
+        return FakeDevice(self)
+
+    def delay(self):
+        with self.lock:
+            return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def dropped(self):
+        with self.lock:
+            return self.random.random() < self.drop_rate
+
+
+class FakeDevice:
+    def __init__(self, fake):
+        self.fake = fake
+        self.path = None
+        self.last_error = ""
+        self.blocking = True
+        self.responses = []
+        self.busy_until = 0.0
+
+    def open_path(self, path):
+        if path not in self.fake.state:
+            raise IOError("open failed")
+        with self.fake.lock:
+            self.fake.opens += 1
+        self.path = path
+
+    def close(self):
+        self.path = None
+
+    def set_nonblocking(self, nonblocking):
+        self.blocking = not nonblocking
+
+    def error(self):
+        return self.last_error
+
+    # Like hidapi, failed writes return -1 and don't raise
+    def write(self, data):
+        if self.path is None:
+            self.last_error = "not open"
+            return -1
+        data = bytes(data)
+        time.sleep(self.fake.write_latency)
+        with self.fake.lock:
+            self.fake.reports += 1
+        # Report ID isn't sent over the wire
+        request = bytearray(data[1:]).ljust(RAW_HID_BUFFER_SIZE, b"\x00")
+        response = self.handle(request)
+        self.busy_until = max(self.busy_until, time.monotonic()) + self.fake.delay()
+        if not self.fake.dropped():
+            self.responses.append((self.busy_until, bytes(response)))
+        return len(data)
+
+    def handle(self, request):
+        state = self.fake.state[self.path]
+        (command, channel, value) = request[0:3]
+        if command in (CUSTOM_SET_VALUE, CUSTOM_GET_VALUE) and channel in self.fake.unsupported:
+            request[0] = 0xFF
+        elif command == CUSTOM_SET_VALUE:
+            state[(channel, value)] = list(request[3:5])
+        elif command == CUSTOM_GET_VALUE:
+            request[3:5] = bytes(state.get((channel, value), [0, 0]))
+        return request
+
+    def read(self, max_length, timeout_ms=0):
+        if self.path is None:
+            raise IOError("not open")
+        now = time.monotonic()
+        if not self.responses:
+            if timeout_ms:
+                time.sleep(timeout_ms / 1000)
+            return []
+        (ready, response) = self.responses[0]
+        if ready > now:
+            if not timeout_ms and not self.blocking:
+                return []
+            wait = ready - now
+            if timeout_ms and wait > timeout_ms / 1000:
+                time.sleep(timeout_ms / 1000)
+                return []
+            time.sleep(wait)
+        self.responses.pop(0)
+        return list(response[:max_length])
@@ -0,0 +1,104 @@
+"""asyncio interface to qmk_hid.protocol
+
+Every function of the same name in qmk_hid.protocol is available here as a
+coroutine, taking an additional timeout keyword argument (seconds).
+The blocking calls run on one worker thread per device, so calls to
+different devices can be awaited concurrently, e.g. with asyncio.gather,
+while calls to the same device are serialized. Every call starts without
+cached state of its device, the keyboard may have been changed in between.
+
+    devices = await aio.find_devs(show=False, verbose=False)
+    await aio.gather(devices, aio.set_rgb_brightness, 100)
+"""
+import asyncio
+import functools
+
+from qmk_hid import protocol
+from qmk_hid.executor import DeviceExecutor
+
+# Default timeout for a call to a device, in seconds
+TIMEOUT = 2.0
+
+_executor = DeviceExecutor()
+_locks = {}
+
+
+def device_lock(dev):
+    """asyncio.Lock of dev, for a batch of calls without others in between
+
+    Only tasks that take the lock wait for each other, the calls themselves
+    don't take it:
+
+        async with aio.device_lock(dev):
+            (hue, saturation) = await aio.get_rgb_color(dev)
+            await aio.set_rgb_color(dev, hue + 10, saturation)
+    """
+    lock = _locks.get(dev['path'])
+    if lock is None:
+        lock = asyncio.Lock()
+        _locks[dev['path']] = lock
+    return lock
+
+
+async def run(dev, fn, *args, timeout=None):
+    """Run the blocking fn(dev, *args) on the worker thread of dev
+
+    Raises asyncio.TimeoutError if it takes longer than timeout seconds.
+    """
+    if timeout is None:
+        timeout = TIMEOUT
+    # The worker of dev already runs one call at a time
+    future = asyncio.wrap_future(_executor.submit(dev, _fresh, fn, *args))
+    return await asyncio.wait_for(future, timeout)
+
+
+def _fresh(dev, fn, *args):
+    protocol.invalidate_state(dev)
+    return fn(dev, *args)
+
+
+async def gather(devices, fn, *args, timeout=None):
+    """Await fn(dev, *args, timeout=timeout) for all devices at once
+
+    Returns a list of results in the order of devices. Exceptions are
+    returned in place of the result, they don't cancel the other devices.
+    """
+    return await asyncio.gather(
+        *[fn(dev, *args, timeout=timeout) for dev in devices],
+        return_exceptions=True,
+    )
+
+
+async def find_devs(show, verbose):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(protocol.find_devs, show, verbose))
+
+
+def _device_coroutine(fn):
+    @functools.wraps(fn)
+    async def wrapper(dev, *args, timeout=None):
+        return await run(dev, fn, *args, timeout=timeout)
+    return wrapper
+
+
+send_message = _device_coroutine(protocol.send_message)
+set_keyboard_value = _device_coroutine(protocol.set_keyboard_value)
+set_rgb_u8 = _device_coroutine(protocol.set_rgb_u8)
+get_rgb_u8 = _device_coroutine(protocol.get_rgb_u8)
+get_rgb_color = _device_coroutine(protocol.get_rgb_color)
+set_rgb_color = _device_coroutine(protocol.set_rgb_color)
+get_backlight = _device_coroutine(protocol.get_backlight)
+set_backlight = _device_coroutine(protocol.set_backlight)
+save = _device_coroutine(protocol.save)
+save_rgb = _device_coroutine(protocol.save_rgb)
+save_backlight = _device_coroutine(protocol.save_backlight)
+eeprom_reset = _device_coroutine(protocol.eeprom_reset)
+bootloader_jump = _device_coroutine(protocol.bootloader_jump)
+bios_mode = _device_coroutine(protocol.bios_mode)
+factory_mode = _device_coroutine(protocol.factory_mode)
+set_rgb_brightness = _device_coroutine(protocol.set_rgb_brightness)
+set_brightness = _device_coroutine(protocol.set_brightness)
+set_white_effect = _device_coroutine(protocol.set_white_effect)
+set_white_rgb_brightness = _device_coroutine(protocol.set_white_rgb_brightness)
+snapshot = _device_coroutine(protocol.snapshot)
+restore = _device_coroutine(protocol.restore)
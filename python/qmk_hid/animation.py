@@ -0,0 +1,301 @@
+"""Host side RGB animations, streamed to the devices frame by frame
+
+The firmware can only show one hue, saturation and brightness per device. An
+effect computes those for every device and every frame, the Animator sends
+them at a fixed frame rate.
+
+    from qmk_hid import animation
+    animator = animation.Animator(devices, animation.Gradient())
+    animator.start()
+    ...
+    animator.stop()
+    print(animator.stats())
+
+NumPy is used to compute the frames if it's installed, it's not required.
+"""
+import math
+import threading
+import time
+
+from qmk_hid.protocol import (
+    CHANNEL_RGB_MATRIX, RGB_MATRIX_VALUE_BRIGHTNESS, RGB_MATRIX_VALUE_COLOR,
+    RGB_MATRIX_VALUE_EFFECT, RGB_EFFECTS, GREEN_HUE, RED_HUE, Transaction,
+    restore, snapshot,
+)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FPS = 60
+# A device can be slowed down to this frame rate, if it can't keep up
+MIN_FPS = 5
+# Frames a device may drop per adaptation window, before its rate is halved
+DROP_THRESHOLD = 0.1
+
+
+def _frame(hues, saturations, brightnesses):
+    """List of (hue, saturation, brightness) with values 0-255, from NumPy arrays or scalars"""
+    columns = np.broadcast_arrays(hues, saturations, brightnesses)
+    return np.stack(columns, axis=-1).astype(np.int64).clip(0, 255).tolist()
+
+
+class Effect:
+    """Computes the frames of an animation
+
+    render(t, count) returns a list of (hue, saturation, brightness) for each
+    of count devices, at t seconds since the start. The animation ends after
+    duration seconds, None runs forever.
+    """
+    duration = None
+
+    def render(self, t, count):
+        raise NotImplementedError
+
+
+class Gradient(Effect):
+    """Hues spread across the devices, moving by speed hue steps per second"""
+
+    def __init__(self, start=RED_HUE, spread=256, speed=64, saturation=255, brightness=255):
+        self.start = start
+        self.spread = spread
+        self.speed = speed
+        self.saturation = saturation
+        self.brightness = brightness
+
+    def render(self, t, count):
+        base = self.start + self.speed * t
+        if np is not None:
+            hues = (base + self.spread * np.arange(count) / count) % 256
+            return _frame(hues, self.saturation, self.brightness)
+        return [[int(base + self.spread * i / count) % 256, self.saturation, self.brightness]
+                for i in range(count)]
+
+
+class Flash(Effect):
+    """Notification, all devices flash a few times in one color"""
+
+    def __init__(self, hue=RED_HUE, flashes=3, period=0.5, saturation=255, brightness=255):
+        self.hue = hue
+        self.period = period
+        self.saturation = saturation
+        self.brightness = brightness
+        self.duration = flashes * period
+
+    def render(self, t, count):
+        # Smooth pulse, off at the start and the end of every period
+        level = math.sin(math.pi * (t % self.period) / self.period) ** 2
+        return [[self.hue, self.saturation, int(self.brightness * level)]] * count
+
+
+class AudioLevel(Effect):
+    """Brightness and hue follow an audio level
+
+    level() returns the current level between 0.0 and 1.0, for example the
+    RMS of the last block of samples from the sound card. Quiet is hue_low,
+    loud is hue_high. The brightness rises immediately and falls off over
+    decay seconds.
+    """
+
+    def __init__(self, level, hue_low=GREEN_HUE, hue_high=RED_HUE, decay=0.3, saturation=255):
+        self.level = level
+        self.hue_low = hue_low
+        self.hue_high = hue_high
+        self.decay = decay
+        self.saturation = saturation
+        self._value = 0.0
+        self._last_t = None
+
+    def render(self, t, count):
+        level = min(1.0, max(0.0, self.level()))
+        if self._last_t is not None and self.decay > 0:
+            falloff = max(0.0, 1.0 - (t - self._last_t) / self.decay)
+            level = max(level, self._value * falloff)
+        (self._value, self._last_t) = (level, t)
+        hue = int(self.hue_low + (self.hue_high - self.hue_low) * level) % 256
+        return [[hue, self.saturation, int(255 * level)]] * count
+
+
+def send_frame(dev, hue, saturation, brightness):
+    """Color and brightness in one transaction, unchanged values aren't sent"""
+    tx = Transaction(dev)
+    tx.set_value(CHANNEL_RGB_MATRIX, RGB_MATRIX_VALUE_COLOR, hue, saturation)
+    tx.set_value(CHANNEL_RGB_MATRIX, RGB_MATRIX_VALUE_BRIGHTNESS, brightness)
+    tx.send()
+
+
+class _DeviceStream:
+    def __init__(self, dev):
+        self.dev = dev
+        # Send only every divider-th frame
+        self.divider = 1
+        self.busy = False
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        # Of the current adaptation window
+        self.window_due = 0
+        self.window_dropped = 0
+
+
+class Animator:
+    """Render an effect and stream it to the devices at a fixed frame rate
+
+    Frames are scheduled on the monotonic clock. If rendering falls behind,
+    frames are skipped rather than sent late. Every device gets its frames
+    from its own executor worker, through the pooled handles. If a device is
+    still busy with its previous frame, the new one is dropped for it. When a
+    device drops more than DROP_THRESHOLD of its frames within a second, it
+    only gets every second frame, down to MIN_FPS. When it keeps up for a
+    second, its rate is raised again.
+    """
+
+    def __init__(self, devices, effect, fps=FPS, executor=None):
+        from qmk_hid.executor import DeviceExecutor
+
+        self.effect = effect
+        self.fps = fps
+        self.interval = 1.0 / fps
+        self.executor = executor or DeviceExecutor()
+        self._own_executor = executor is None
+        self._streams = [_DeviceStream(dev) for dev in devices]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._snapshots = []
+        self.frames = 0
+        self.skipped = 0
+
+    def start(self, solid_color=True, restore_state=True):
+        """Start streaming in a background thread
+
+        With solid_color, the devices are switched to the SOLID_COLOR effect
+        first, otherwise the firmware effect might not show the color. With
+        restore_state, stop() puts back the lighting the devices had before.
+        """
+        if restore_state:
+            self._snapshots = [(stream.dev, self.executor.submit(stream.dev, snapshot))
+                               for stream in self._streams]
+        if solid_color:
+            effect = RGB_EFFECTS.index("SOLID_COLOR")
+            for stream in self._streams:
+                self.executor.submit(stream.dev, self._set_effect, effect)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="qmk_hid-animation", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        # Not saved, the settings in EEPROM weren't touched
+        restored = [self.executor.submit(dev, self._restore, future) for (dev, future) in self._snapshots]
+        self._snapshots = []
+        for future in restored:
+            try:
+                future.result()
+            except Exception:
+                pass
+        if self._own_executor:
+            self.executor.shutdown()
+
+    def wait(self, timeout=None):
+        """Wait until the effect is over, returns False on timeout"""
+        if self._thread:
+            self._thread.join(timeout)
+            return not self._thread.is_alive()
+        return True
+
+    def stats(self):
+        """Frames rendered and skipped, and per device path the frames sent,
+        dropped, errors and its current frame rate"""
+        with self._lock:
+            return {
+                'frames': self.frames,
+                'skipped': self.skipped,
+                'devices': {
+                    stream.dev['path']: {
+                        'sent': stream.sent,
+                        'dropped': stream.dropped,
+                        'errors': stream.errors,
+                        'fps': self.fps / stream.divider,
+                    } for stream in self._streams
+                },
+            }
+
+    @staticmethod
+    def _set_effect(dev, effect):
+        tx = Transaction(dev)
+        tx.set_value(CHANNEL_RGB_MATRIX, RGB_MATRIX_VALUE_EFFECT, effect)
+        tx.send()
+
+    @staticmethod
+    def _restore(dev, snapshot_future):
+        # The last frames are in the cache, no need to read them back
+        restore(dev, snapshot_future.result(), save=False, use_cache=True)
+
+    def _run(self):
+        start = time.monotonic()
+        next_adapt = start + 1.0
+        frame_no = 0
+        while not self._stop.is_set():
+            deadline = start + frame_no * self.interval
+            now = time.monotonic()
+            if now < deadline:
+                if self._stop.wait(deadline - now):
+                    break
+            elif now - deadline > self.interval:
+                # Fell behind, continue with the current frame instead of catching up
+                behind = int((now - deadline) / self.interval)
+                with self._lock:
+                    self.skipped += behind
+                frame_no += behind
+                deadline = start + frame_no * self.interval
+
+            t = deadline - start
+            if self.effect.duration is not None and t > self.effect.duration:
+                break
+            frame = self.effect.render(t, len(self._streams))
+            with self._lock:
+                self.frames += 1
+            for (stream, (hue, saturation, brightness)) in zip(self._streams, frame):
+                self._submit(stream, frame_no, hue, saturation, brightness)
+            if deadline >= next_adapt:
+                self._adapt()
+                next_adapt += 1.0
+            frame_no += 1
+
+    def _submit(self, stream, frame_no, hue, saturation, brightness):
+        if frame_no % stream.divider:
+            return
+        with self._lock:
+            stream.window_due += 1
+            if stream.busy:
+                stream.dropped += 1
+                stream.window_dropped += 1
+                return
+            stream.busy = True
+
+        def done(future):
+            with self._lock:
+                stream.busy = False
+                if future.exception() is None:
+                    stream.sent += 1
+                else:
+                    stream.errors += 1
+
+        future = self.executor.submit(stream.dev, send_frame, hue, saturation, brightness)
+        future.add_done_callback(done)
+
+    def _adapt(self):
+        max_divider = max(1, self.fps // MIN_FPS)
+        with self._lock:
+            for stream in self._streams:
+                if stream.window_due and stream.window_dropped > stream.window_due * DROP_THRESHOLD:
+                    stream.divider = min(stream.divider * 2, max_divider)
+                elif stream.window_dropped == 0 and stream.divider > 1:
+                    stream.divider //= 2
+                stream.window_due = 0
+                stream.window_dropped = 0
@@ -0,0 +1,354 @@
+"""Command line interface
+
+    qmk_hid list
+    qmk_hid brightness 100
+    qmk_hid color red
+    qmk_hid daemon &
+
+While a daemon is running, all other invocations are forwarded to it, so
+devices are only enumerated and opened once. Scripts can also talk to the
+socket directly, one command per line, e.g.
+
+    echo "brightness 50" | socat - UNIX-CONNECT:$XDG_RUNTIME_DIR/qmk_hid.sock
+
+Each response ends with a line "ok" or "error: <message>".
+"""
+import argparse
+import os
+import shlex
+import socket
+import sys
+
+HUES = {
+    "red": 0,
+    "yellow": 43,
+    "green": 85,
+    "cyan": 125,
+    "blue": 170,
+    "purple": 213,
+}
+
+
+class CliError(Exception):
+    pass
+
+
+class ArgumentParser(argparse.ArgumentParser):
+    # Don't exit, the daemon has to keep running
+    def error(self, message):
+        raise CliError(message)
+
+
+def default_socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "qmk_hid.sock")
+    import getpass
+    import tempfile
+    return os.path.join(tempfile.gettempdir(), "qmk_hid-{}.sock".format(getpass.getuser()))
+
+
+def build_parser():
+    parser = ArgumentParser(prog="qmk_hid", description="Control QMK keyboards of the Framework Laptop 16")
+    parser.add_argument('-d', '--device', help='only this HID path')
+    parser.add_argument('-s', '--serial', help='only the device with this serial number')
+    parser.add_argument('--socket', help='daemon socket (default: {})'.format(default_socket_path()))
+    parser.add_argument('--no-daemon', action='store_true', help="don't forward to a running daemon")
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+    subparsers.required = True
+
+    subparsers.add_parser('list', help='list devices')
+    sub = subparsers.add_parser('brightness', help='get or set white and RGB brightness')
+    sub.add_argument('value', nargs='?', type=parse_byte, help='0-255')
+    sub = subparsers.add_parser('effect', help='get or set the RGB effect')
+    sub.add_argument('value', nargs='?', type=parse_effect, help='name or index of the effect')
+    sub = subparsers.add_parser('color', help='get or set the RGB color')
+    sub.add_argument('hue', nargs='?', type=parse_hue, help='0-255 or one of: ' + ", ".join(HUES))
+    sub.add_argument('saturation', nargs='?', type=parse_byte, default=255, help='0-255 (default: 255)')
+    subparsers.add_parser('save', help='save the current settings to EEPROM')
+    subparsers.add_parser('bootloader', help='jump to the bootloader')
+    sub = subparsers.add_parser('animate', help='stream an animation from this computer, until Ctrl-C')
+    sub.add_argument('effect', choices=['gradient', 'flash'])
+    sub.add_argument('--hue', type=parse_hue, default='red', help='of flash, 0-255 or one of: ' + ", ".join(HUES))
+    sub.add_argument('--fps', type=int, default=60, help='frames per second (default: 60)')
+    sub.add_argument('--duration', type=float, help='stop after this many seconds')
+    sub = subparsers.add_parser('daemon', help='keep devices open and serve commands on a Unix socket')
+    sub.add_argument('--metrics', action='store_true', help='collect metrics, shown by the "metrics" command')
+    sub = subparsers.add_parser('metrics', help='metrics of the daemon')
+    sub.add_argument('--json', action='store_true', help='as JSON instead of Prometheus text')
+    return parser
+
+
+def select_devices(args, devices):
+    if args.device:
+        devices = [dev for dev in devices if dev['path'].decode(errors='replace') == args.device]
+    if args.serial:
+        devices = [dev for dev in devices if dev['serial_number'] == args.serial]
+    if not devices:
+        raise CliError("No matching device found")
+    return devices
+
+
+# Argument types, invalid values are usage errors before any device is opened
+
+def parse_byte(value):
+    try:
+        number = int(value, 0)
+    except ValueError:
+        # int(value, 0) doesn't take leading zeros like 050
+        try:
+            number = int(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError("'{}' is not a number".format(value))
+    if not 0 <= number <= 255:
+        raise argparse.ArgumentTypeError("{} is out of range 0-255".format(value))
+    return number
+
+
+def parse_effect(value):
+    from qmk_hid.protocol import RGB_EFFECTS
+    if value.upper() in RGB_EFFECTS:
+        return RGB_EFFECTS.index(value.upper())
+    try:
+        return parse_byte(value)
+    except argparse.ArgumentTypeError:
+        if value.lstrip("-").isdigit():
+            raise
+        raise argparse.ArgumentTypeError("Unknown effect '{}'".format(value))
+
+
+def parse_hue(value):
+    if value.lower() in HUES:
+        return HUES[value.lower()]
+    try:
+        return parse_byte(value)
+    except argparse.ArgumentTypeError:
+        if value.lstrip("-").isdigit():
+            raise
+        raise argparse.ArgumentTypeError("Unknown color '{}'".format(value))
+
+
+def run_command(args, devices, executor, out):
+    """Run a parsed command on the selected devices, writing output to out"""
+    from qmk_hid import protocol
+
+    if args.command == 'metrics':
+        from qmk_hid import metrics
+        out.write(metrics.to_json() + "\n" if args.json else metrics.to_prometheus())
+        return
+    if args.command == 'list':
+        for dev in devices:
+            out.write("{}\n  Serial No:  {}\n  FW Version: {}\n  Path:       {}\n".format(
+                dev['product_string'],
+                dev['serial_number'],
+                protocol.format_fw_ver(dev['release_number']),
+                dev['path'].decode(errors='replace'),
+            ))
+        return
+
+    devices = select_devices(args, devices)
+    if args.command == 'brightness':
+        if args.value is None:
+            def action(dev):
+                return "white {}, rgb {}".format(
+                    protocol.get_backlight(dev, protocol.BACKLIGHT_VALUE_BRIGHTNESS),
+                    protocol.get_rgb_u8(dev, protocol.RGB_MATRIX_VALUE_BRIGHTNESS),
+                )
+        else:
+            def action(dev):
+                protocol.set_white_rgb_brightness(dev, args.value)
+    elif args.command == 'effect':
+        if args.value is None:
+            def action(dev):
+                effect = protocol.get_rgb_u8(dev, protocol.RGB_MATRIX_VALUE_EFFECT)
+                if effect is None or effect >= len(protocol.RGB_EFFECTS):
+                    return effect
+                return "{} ({})".format(protocol.RGB_EFFECTS[effect], effect)
+        else:
+            def action(dev):
+                protocol.set_rgb_u8(dev, protocol.RGB_MATRIX_VALUE_EFFECT, args.value)
+    elif args.command == 'color':
+        if args.hue is None:
+            def action(dev):
+                return "hue {}, saturation {}".format(*protocol.get_rgb_color(dev))
+        else:
+            def action(dev):
+                protocol.set_rgb_color(dev, args.hue, args.saturation)
+    elif args.command == 'save':
+        action = protocol.save
+    elif args.command == 'bootloader':
+        action = protocol.bootloader_jump
+    elif args.command == 'animate':
+        animate(args, devices, executor, out)
+        return
+    else:
+        raise CliError("Unknown command '{}'".format(args.command))
+
+    failed = False
+    for r in executor.run(devices, action):
+        name = r.dev['path'].decode(errors='replace')
+        if r.error is not None:
+            out.write("{}: error: {}\n".format(name, r.error))
+            failed = True
+        elif r.result is not None:
+            out.write("{}: {}\n".format(name, r.result))
+    if failed:
+        raise CliError("Command failed on some devices")
+
+
+def animate(args, devices, executor, out):
+    from qmk_hid import animation
+
+    if args.effect == 'flash':
+        effect = animation.Flash(hue=args.hue)
+    else:
+        effect = animation.Gradient()
+    animator = animation.Animator(devices, effect, fps=args.fps, executor=executor)
+    animator.start()
+    try:
+        animator.wait(args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        animator.stop()
+    stats = animator.stats()
+    out.write("{} frames, {} skipped\n".format(stats['frames'], stats['skipped']))
+    for (path, s) in stats['devices'].items():
+        out.write("{}: {} sent, {} dropped, {} errors, {:.0f} fps\n".format(
+            path.decode(errors='replace'), s['sent'], s['dropped'], s['errors'], s['fps']))
+
+
+def serve(args):
+    """Keep devices open and run commands received on the socket"""
+    import socketserver
+    from qmk_hid import metrics, protocol
+    from qmk_hid.executor import DeviceExecutor
+    from qmk_hid.hotplug import DeviceMonitor
+
+    if args.metrics:
+        metrics.enable()
+    monitor = DeviceMonitor()
+    monitor.start()
+    executor = DeviceExecutor()
+    parser = build_parser()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            out = _TextWriter(self.wfile)
+            for line in self.rfile:
+                line = line.decode(errors='replace').strip()
+                if not line:
+                    continue
+                try:
+                    cmd_args = parser.parse_args(shlex.split(line))
+                    if cmd_args.command == 'daemon':
+                        raise CliError("Daemon is already running")
+                    if cmd_args.command == 'animate':
+                        # Would keep running after the client is gone
+                        raise CliError("Animations can't run in the daemon")
+                    if cmd_args.command not in ('list', 'metrics'):
+                        # The daemon outlives changes made on the keyboard
+                        # itself, e.g. with the brightness hotkeys
+                        protocol.invalidate_state()
+                    run_command(cmd_args, monitor.devices, executor, out)
+                    out.write("ok\n")
+                except (CliError, ValueError) as ex:
+                    out.write("error: {}\n".format(ex))
+
+    path = args.socket or default_socket_path()
+    if os.path.exists(path):
+        # Left over from a daemon that didn't shut down cleanly
+        if _connect(path) is not None:
+            raise CliError("Daemon is already running on {}".format(path))
+        os.unlink(path)
+    server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    os.chmod(path, 0o600)
+    print("Listening on {}".format(path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+        monitor.stop()
+        executor.shutdown(wait=False)
+
+
+class _TextWriter:
+    def __init__(self, raw):
+        self.raw = raw
+
+    def write(self, text):
+        self.raw.write(text.encode())
+
+
+def _connect(path):
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return sock
+    except OSError:
+        sock.close()
+        return None
+
+
+def forward(sock, argv):
+    """Send the command to the daemon, print its output. Returns exit code"""
+    with sock:
+        sock.sendall((" ".join(shlex.quote(arg) for arg in argv) + "\n").encode())
+        sock.shutdown(socket.SHUT_WR)
+        response = b""
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+    lines = response.decode(errors='replace').splitlines()
+    for line in lines[:-1]:
+        print(line)
+    if lines and lines[-1] == "ok":
+        return 0
+    print(lines[-1] if lines else "error: No response from daemon", file=sys.stderr)
+    return 1
+
+
+def main_cli(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = build_parser()
+    try:
+        args = parser.parse_args(argv)
+    except CliError as ex:
+        parser.print_usage(sys.stderr)
+        print("error: {}".format(ex), file=sys.stderr)
+        sys.exit(2)
+
+    try:
+        if args.command == 'daemon':
+            serve(args)
+            return
+
+        # Skip enumerating and opening devices if the daemon has them open.
+        # Animations run here, they stop when this process does.
+        if not args.no_daemon and args.command != 'animate':
+            sock = _connect(args.socket or default_socket_path())
+            if sock is not None:
+                sys.exit(forward(sock, [arg for arg in argv if arg != '--no-daemon']))
+
+        from qmk_hid.executor import DeviceExecutor
+        from qmk_hid.protocol import find_devs
+        executor = DeviceExecutor()
+        try:
+            run_command(args, find_devs(show=False, verbose=False), executor, sys.stdout)
+        finally:
+            executor.shutdown()
+    except CliError as ex:
+        print("error: {}".format(ex), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,126 @@
+import threading
+import time
+from collections import namedtuple
+
+# Outcome of running an action on one device.
+# Either result or error is set, error being the exception the action raised.
+ActionResult = namedtuple('ActionResult', ['dev', 'result', 'error'])
+
+
+class DeviceExecutor:
+    """Run actions on several devices concurrently
+
+    Every HID path gets its own worker thread. Actions on the same device run
+    in the order they were submitted, different devices don't wait on each
+    other.
+    """
+
+    def __init__(self):
+        self._workers = {}
+        self._lock = threading.Lock()
+
+    def _worker(self, dev):
+        path = dev['path']
+        with self._lock:
+            worker = self._workers.get(path)
+            if worker is None:
+                # concurrent.futures is slow to import, wait until it's needed
+                from concurrent.futures import ThreadPoolExecutor
+                worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qmk_hid-dev")
+                self._workers[path] = worker
+            return worker
+
+    def submit(self, dev, fn, *args):
+        """Queue fn(dev, *args) on the worker of dev. Returns a Future"""
+        return self._worker(dev).submit(fn, dev, *args)
+
+    def submit_all(self, devices, fn, *args):
+        """Queue fn(dev, *args) for every device. Returns a list of Futures"""
+        return [self.submit(dev, fn, *args) for dev in devices]
+
+    def run(self, devices, fn, *args):
+        """Run fn(dev, *args) on all devices at once and wait for all of them
+
+        Returns a list of ActionResult, in the same order as devices.
+        Exceptions are collected in the results instead of being raised.
+        """
+        futures = self.submit_all(devices, fn, *args)
+        return [future_result(dev, future) for (dev, future) in zip(devices, futures)]
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            workers = list(self._workers.values())
+            self._workers.clear()
+        for worker in workers:
+            worker.shutdown(wait=wait)
+
+
+class Coalescer:
+    """Latest-value-wins writes of one setting to many devices
+
+    Meant for sliders, which produce values much faster than the firmware can
+    apply them. Values that get superseded before they were sent are dropped,
+    each device gets at most `rate` writes per second and the last value
+    submitted is always written.
+    """
+
+    def __init__(self, executor, fn, rate=30):
+        self.executor = executor
+        self.fn = fn
+        self.interval = 1.0 / rate
+        self._latest = {}
+        self._scheduled = set()
+        self._last_sent = {}
+        self._lock = threading.Lock()
+
+    def submit(self, dev, value):
+        """Queue fn(dev, value)
+
+        Returns a Future if a new write was scheduled, or None if the value
+        was merged into a write that's already pending.
+        """
+        path = dev['path']
+        with self._lock:
+            self._latest[path] = value
+            if path in self._scheduled:
+                return None
+            self._scheduled.add(path)
+        return self.executor.submit(dev, self._drain)
+
+    def submit_all(self, devices, value):
+        return [self.submit(dev, value) for dev in devices]
+
+    # Runs on the worker of dev, until no newer value is waiting
+    def _drain(self, dev):
+        path = dev['path']
+        while True:
+            wait = self._last_sent.get(path, 0) + self.interval - time.monotonic()
+            if wait > 0:
+                # Values arriving in the meantime replace the one we'd send
+                time.sleep(wait)
+            with self._lock:
+                if path not in self._latest:
+                    self._scheduled.discard(path)
+                    return
+                value = self._latest.pop(path)
+            self._last_sent[path] = time.monotonic()
+            try:
+                self.fn(dev, value)
+            except Exception:
+                # Values submitted in the meantime were merged into this
+                # drain, they still have to be written
+                with self._lock:
+                    pending = path in self._latest
+                    if not pending:
+                        self._scheduled.discard(path)
+                if pending:
+                    self.executor.submit(dev, self._drain)
+                raise
+
+
+def future_result(dev, future):
+    """Wait for a Future of an action on dev and wrap its outcome in ActionResult"""
+    try:
+        return ActionResult(dev, future.result(), None)
+    except Exception as ex:
+        return ActionResult(dev, None, ex)
@@ -1,46 +1,366 @@
 import os
-import time
+import sys
+import threading
 
-from qmk_hid.protocol import bootloader_jump
-from qmk_hid import uf2conv
+from qmk_hid.protocol import bootloader_jump, format_fw_ver
 
 def dev_to_str(dev):
     return dev['path']
 
-def flash_firmware(dev, fw_path):
-    print(f"Flashing {fw_path} onto {dev_to_str(dev)}")
+# Of the RP2040 bootloader, in INFO_UF2.TXT
+# It's the same for every device, so it can't tell drives apart.
+BOOTLOADER_BOARD_ID = "RPI-RP2"
+# Seconds until the bootloader drive must be mounted
+DRIVE_TIMEOUT = 10.0
+# Seconds until the bootloader must have rebooted after the copy
+REBOOT_TIMEOUT = 10.0
+# Written and synced at once, a multiple of the UF2 block size
+COPY_CHUNK = 64 * 1024
+
+
+class DriveMapper:
+    """Find the bootloader drive of each device, to flash several at once
+
+    Where the USB port of devices and drives is known (Linux), the drive in
+    the same port belongs to the device, so all devices can jump to the
+    bootloader at the same time. Otherwise devices take turns jumping and
+    waiting for the one new drive. Either way, copying runs in parallel.
+
+    Share one instance between the threads flashing the devices.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def jump_and_wait(self, dev, timeout=DRIVE_TIMEOUT):
+        """Jump to the bootloader, returns the drive of dev or None"""
+        from qmk_hid import uf2conv
+        from qmk_hid.hotplug import device_usb_port, drive_usb_port, wait_for_drives
+
+        port = device_usb_port(dev)
+        if port is not None:
+            bootloader_jump(dev)
+            drives = wait_for_drives(timeout, board=BOOTLOADER_BOARD_ID,
+                                     match=lambda drive: drive_usb_port(drive) == port)
+            return drives[0] if drives else None
+
+        with self._lock:
+            existing = uf2conv.get_drives()
+            bootloader_jump(dev)
+            drives = wait_for_drives(timeout, board=BOOTLOADER_BOARD_ID, ignore=existing)
+            return drives[0] if drives else None
+
+
+def copy_firmware(drive, fw_buf, on_progress=None):
+    """Copy the image onto the bootloader drive, synced to the device
+
+    on_progress(written, total) is called after every COPY_CHUNK bytes.
+    """
+    view = memoryview(fw_buf)
+    written = 0
+    try:
+        with open(os.path.join(drive, "NEW.UF2"), "wb") as f:
+            while written < len(view):
+                chunk = view[written:written + COPY_CHUNK]
+                f.write(chunk)
+                f.flush()
+                written += len(chunk)
+                os.fsync(f.fileno())
+                if on_progress:
+                    on_progress(written, len(view))
+    except OSError:
+        # The bootloader reboots as soon as it has all blocks, that can make
+        # syncing or closing the file fail. Check that the drive is gone after.
+        if written < len(view):
+            raise
+
+
+def parse_version(version):
+    """'0.1.8' or 'v0.1.8' as (0, 1, 8), None if it isn't a version"""
+    try:
+        return tuple(int(part) for part in version.lstrip("v").split("."))
+    except (AttributeError, ValueError):
+        return None
+
+
+# Held while flashed.json is updated, devices are flashed in parallel
+_flashed_lock = threading.Lock()
+
+
+def _flashed_path():
+    return os.path.join(cache_dir(), "flashed.json")
+
+
+def _load_flashed():
+    import json
+    try:
+        with open(_flashed_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-    # First jump to bootloader
-    drives = uf2conv.list_drives()
-    if not drives:
-        print("Jump to bootloader")
-        bootloader_jump(dev)
-
-    timeout = 10  # 5s
-    while not drives:
-        if timeout == 0:
-            print("Failed to find device in bootloader")
-            # TODO: Handle return value
-            return False
-        # Wait for it to appear
-        time.sleep(0.5)
-        timeout -= 1
-        drives = uf2conv.get_drives()
-
-
-    if len(drives) == 0:
-        print("No drive to deploy.")
+
+def record_flashed(dev, sha256, version=None):
+    """Remember which image was flashed onto the device, by serial number"""
+    with _flashed_lock:
+        flashed = _load_flashed()
+        flashed[dev['serial_number']] = {'sha256': sha256, 'version': version}
+        try:
+            _write_cache_file(_flashed_path(), flashed)
+        except OSError as ex:
+            print(f"Failed to record the flashed image: {ex}")
+
+
+def file_sha256(path):
+    import hashlib
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# SHA-256 of the images listed by find_releases, by path
+_release_hashes = {}
+
+
+def release_sha256(fw_path):
+    """SHA-256 of a release image, from the release index if it's listed there"""
+    sha256 = _release_hashes.get(fw_path)
+    return sha256 if sha256 is not None else file_sha256(fw_path)
+
+
+def is_up_to_date(dev, version, fw_type=None, sha256=None):
+    """Whether dev already runs this firmware, so flashing can be skipped
+
+    The running firmware must have the version. If the device was flashed
+    with a known version by this tool before, that image must have the
+    sha256, if given. Otherwise fw_type must be part of the product name,
+    like 'ansi' in 'Laptop 16 Keyboard Module - ANSI'.
+    """
+    target = parse_version(version)
+    if target is None or parse_version(format_fw_ver(dev['release_number'])) != target:
         return False
+    record = _load_flashed().get(dev['serial_number'])
+    if sha256 is not None and record is not None and parse_version(record['version']) == target:
+        return record['sha256'] == sha256
+    return fw_type is None or fw_type.lower() in (dev['product_string'] or "").lower().split()
+
+
+def flash_firmware(dev, fw_path, timeout=DRIVE_TIMEOUT, mapper=None, on_progress=None,
+                   version=None, fw_type=None, force=False, sha256=None):
+    """Flash the UF2 image fw_path onto dev
+
+    To flash several devices in parallel, call this from one thread per
+    device with the same mapper. on_progress(written, total) reports the
+    progress of the copy. Returns True once the device rebooted.
+
+    If the version of the image is given, devices that already run it (see
+    is_up_to_date) are skipped, unless force is set. That returns True right
+    away. sha256 of the image can be passed if it's known already, e.g. from
+    release_sha256, otherwise it's computed.
+    """
+    import hashlib
+    from qmk_hid import uf2conv
+    from qmk_hid.hotplug import wait_for_drive_removed
 
     # Firmware is pretty small, can just fit it all into memory
     with open(fw_path, 'rb') as f:
         fw_buf = f.read()
+    if sha256 is None:
+        sha256 = hashlib.sha256(fw_buf).hexdigest()
 
-    for d in drives:
-        print("Flashing {} ({})".format(d, uf2conv.board_id(d)))
-        uf2conv.write_file(d + "/NEW.UF2", fw_buf)
+    if version is not None and not force and is_up_to_date(dev, version, fw_type, sha256):
+        print(f"{dev_to_str(dev)} already runs {fw_path}")
+        return True
 
+    print(f"Flashing {fw_path} onto {dev_to_str(dev)}")
+
+    if mapper is None:
+        mapper = DriveMapper()
+    print("Jump to bootloader")
+    drive = mapper.jump_and_wait(dev, timeout)
+    if drive is None:
+        print("Failed to find device in bootloader")
+        return False
+
+    print("Flashing {} ({})".format(drive, uf2conv.board_id(drive)))
+    copy_firmware(drive, fw_buf, on_progress)
+    if not wait_for_drive_removed(drive, REBOOT_TIMEOUT):
+        print("Bootloader didn't reboot after flashing {}".format(drive))
+        return False
+
+    record_flashed(dev, sha256, version)
     print("Flashing finished")
+    return True
+
+
+# Format of the cached release index, bump when it changes
+RELEASE_INDEX_FORMAT = 3
+
+
+def _write_cache_file(path, data):
+    """Replace the JSON file at path at once, another instance might be reading it"""
+    import json
+    import tempfile
+    os.makedirs(cache_dir(), exist_ok=True)
+    # Unique name, another instance of the tool may be writing too
+    (fd, tmp_path) = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=cache_dir())
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def cache_dir():
+    """Per-user cache directory of qmk_hid"""
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~\\AppData\\Local")
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "qmk_hid")
+
+
+def image_info(fw_buf):
+    """Check that fw_buf is a valid UF2 image for one family
+
+    Returns a dict with its 'size', 'blocks', 'family_id' and 'sha256'.
+    Raises ValueError if it isn't valid.
+    """
+    import hashlib
+    from qmk_hid import uf2conv
+
+    if not fw_buf or len(fw_buf) % 512 or not uf2conv.is_uf2(fw_buf):
+        raise ValueError("Not a UF2 file")
+    summary = uf2conv.summarize_uf2(fw_buf)
+    if summary['bad_blocks']:
+        raise ValueError("{} blocks with bad magic".format(summary['bad_blocks']))
+    families = [family for family in summary['families'] if family is not None]
+    if len(families) != 1 or len(summary['families']) != 1:
+        raise ValueError("Not for exactly one family")
+    return {
+        'size': len(fw_buf),
+        'blocks': summary['blocks'],
+        'family_id': families[0],
+        'sha256': hashlib.sha256(fw_buf).hexdigest(),
+    }
+
+
+def _release_files(releases_dir, mtimes=True):
+    """Size and modification time of every file in the version directories,
+    by relative path"""
+    files = {}
+    for version in os.listdir(releases_dir):
+        path = os.path.join(releases_dir, version)
+        if not os.path.isdir(path):
+            continue
+        for entry in os.scandir(path):
+            if entry.is_file():
+                stat = entry.stat()
+                files[os.path.join(version, entry.name)] = [stat.st_size, stat.st_mtime_ns if mtimes else None]
+    return files
+
+
+def _is_bundled(path):
+    """Whether path was extracted from the PyInstaller one-file executable"""
+    bundle = getattr(sys, '_MEIPASS', None)
+    if not getattr(sys, 'frozen', False) or bundle is None:
+        return False
+    return os.path.commonpath([os.path.abspath(path), os.path.abspath(bundle)]) == os.path.abspath(bundle)
+
+
+def _scan_releases(releases_dir, filename_format):
+    import re
+
+    images = []
+    for version in sorted(os.listdir(releases_dir)):
+        path = os.path.join(releases_dir, version)
+        if not os.path.isdir(path):
+            continue
+        for filename in sorted(os.listdir(path)):
+            if not os.path.isfile(os.path.join(path, filename)):
+                continue
+            type_search = re.search(filename_format, filename)
+            if not type_search:
+                print(f"Filename '{filename}' not matching pattern, skipping")
+                continue
+            with open(os.path.join(path, filename), 'rb') as f:
+                fw_buf = f.read()
+            try:
+                info = image_info(fw_buf)
+            except ValueError as ex:
+                print(f"Firmware '{filename}' is invalid, skipping: {ex}")
+                continue
+            info.update({
+                'version': version,
+                'type': type_search.group(1),
+                'path': os.path.join(version, filename),
+            })
+            images.append(info)
+    return images
+
+
+def release_index(res_path, filename_format):
+    """Validated firmware images in res_path/releases
+
+    A list of dicts with 'version', 'type', 'path' (relative to the releases
+    directory) and the image_info of each. Images that don't match
+    filename_format or aren't valid UF2 are left out.
+
+    The index is cached in cache_dir(), one per releases directory, and
+    only built again when a file was added, removed, or changed in size or
+    modification time. The PyInstaller one-file bundle extracts to a new
+    directory with new modification times on every launch. Its index is
+    kept per executable instead, and built again when the executable changed.
+    """
+    import hashlib
+    import json
+
+    releases_dir = os.path.join(res_path, "releases")
+    bundled = _is_bundled(res_path)
+    if bundled:
+        stat = os.stat(sys.executable)
+        source = os.path.abspath(sys.executable)
+        source_version = [stat.st_size, stat.st_mtime_ns]
+    else:
+        source = os.path.abspath(releases_dir)
+        source_version = None
+    cache_path = os.path.join(cache_dir(), "releases-{}.json".format(
+        hashlib.sha256(source.encode(errors='replace')).hexdigest()[:16]))
+    try:
+        files = _release_files(releases_dir, mtimes=not bundled)
+    except FileNotFoundError:
+        return []
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+        if cache['format'] == RELEASE_INDEX_FORMAT and cache['filename_format'] == filename_format \
+                and cache['source'] == source and cache['source_version'] == source_version \
+                and cache['files'] == files:
+            return cache['images']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    try:
+        images = _scan_releases(releases_dir, filename_format)
+    except FileNotFoundError:
+        return []
+
+    cache = {
+        'format': RELEASE_INDEX_FORMAT,
+        'filename_format': filename_format,
+        'source': source,
+        'source_version': source_version,
+        'files': files,
+        'images': images,
+    }
+    try:
+        _write_cache_file(cache_path, cache)
+    except OSError as ex:
+        print(f"Failed to cache the release index: {ex}")
+    return images
 
 
 # Example return value
@@ -55,27 +375,10 @@ def flash_firmware(dev, fw_path):
 #   }
 # }
 def find_releases(res_path, filename_format):
-    from os import listdir
-    from os.path import isfile, join
-    import re
-
     releases = {}
-    try:
-        versions = listdir(os.path.join(res_path, "releases"))
-    except FileNotFoundError:
-        return releases
-
-    for version in versions:
-        path = join(res_path, "releases", version)
-        releases[version] = {}
-        for filename in listdir(path):
-            if not isfile(join(path, filename)):
-                continue
-            type_search = re.search(filename_format, filename)
-            if not type_search:
-                print(f"Filename '{filename}' not matching patten!")
-                sys.exit(1)
-                continue
-            fw_type = type_search.group(1)
-            releases[version][fw_type] = os.path.join(res_path, "releases", version, filename)
+    releases_dir = os.path.join(res_path, "releases")
+    for image in release_index(res_path, filename_format):
+        path = os.path.join(releases_dir, image['path'])
+        releases.setdefault(image['version'], {})[image['type']] = path
+        _release_hashes[path] = image['sha256']
     return releases
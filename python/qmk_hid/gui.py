@@ -1,45 +1,119 @@
 #!/usr/bin/env python3
 import os
+import queue
 import sys
-import subprocess
+import threading
 import time
 
 import tkinter as tk
-from tkinter import ttk, messagebox
-
-if os.name == 'nt':
-    from win32api import GetKeyState, keybd_event
-    from win32con import VK_NUMLOCK, VK_CAPITAL
-    import winreg
-
-import webbrowser
+from tkinter import ttk
 
+# subprocess, webbrowser, the Windows APIs and the firmware update code are
+# only imported when they are used, to keep startup fast.
 from qmk_hid.protocol import *
-from qmk_hid import firmware_update
-
-# TODO:
-# - Get current values
-#   - Set sliders to current values
+from qmk_hid import metrics
+from qmk_hid.executor import Coalescer, DeviceExecutor, future_result
+from qmk_hid.hotplug import DeviceMonitor
 
 PROGRAM_VERSION = "0.2.0"
 
 DEBUG_PRINT = False
 
+# Talks to all selected devices in parallel, one worker thread per device
+executor = DeviceExecutor()
+
+# Max brightness updates per second and device while dragging the slider
+BRIGHTNESS_REPORT_RATE = 30
+brightness_coalescer = Coalescer(executor, set_white_rgb_brightness, rate=BRIGHTNESS_REPORT_RATE)
+
+class TkDispatcher:
+    """Hand work done in background threads back to the Tk main loop
+
+    Tk may only be used from the thread running mainloop, so worker threads
+    queue their callbacks here and they get run from root.after. While work is
+    in flight the progress bar keeps moving.
+    """
+    # About one frame
+    POLL_MS = 15
+
+    def __init__(self, root, progress):
+        self.root = root
+        self.progress = progress
+        self.queue = queue.Queue()
+        self.busy = 0
+        root.after(self.POLL_MS, self._poll)
+
+    def call_soon(self, fn, *args):
+        """Run fn(*args) on the Tk thread. Safe to call from any thread"""
+        self.queue.put((fn, args))
+
+    def _poll(self):
+        while True:
+            try:
+                (fn, args) = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            fn(*args)
+        self.root.after(self.POLL_MS, self._poll)
+
+    def begin(self):
+        if self.busy == 0:
+            self.progress.start()
+        self.busy += 1
+
+    def end(self):
+        self.busy -= 1
+        if self.busy == 0:
+            self.progress.stop()
+
+    def run_on_devices(self, devices, fn, on_done=None):
+        """Run fn(dev) on all devices in the background
+
+        on_done gets the list of ActionResult, called on the Tk thread once
+        all devices are finished.
+        """
+        self.track(devices, executor.submit_all(devices, fn), on_done)
+
+    def track(self, devices, futures, on_done=None):
+        """Like run_on_devices, but for already submitted futures, one per device"""
+        if not devices:
+            return
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def finish():
+            self.end()
+            results = [future_result(dev, future) for (dev, future) in zip(devices, futures)]
+            for r in results:
+                if r.error is not None:
+                    debug_print("Error ({}): ".format(r.dev['path']), r.error)
+            disable_devices([r.dev for r in results if r.error is not None])
+            if on_done:
+                on_done(results)
+
+        def one_done(_future):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self.call_soon(finish)
+
+        self.begin()
+        for future in futures:
+            future.add_done_callback(one_done)
+
+
 def debug_print(*args):
     if DEBUG_PRINT:
         print(args)
 
-def format_fw_ver(fw_ver):
-    fw_ver_major = (fw_ver & 0xFF00) >> 8
-    fw_ver_minor = (fw_ver & 0x00F0) >> 4
-    fw_ver_patch = (fw_ver & 0x000F)
-    return f"{fw_ver_major}.{fw_ver_minor}.{fw_ver_patch}"
-
-
 def get_numlock_state():
     if os.name == 'nt':
+        from win32api import GetKeyState
+        from win32con import VK_NUMLOCK
         return GetKeyState(VK_NUMLOCK)
     else:
+        import subprocess
         try:
             # TODO: This doesn't work on wayland
             # In GNOME we can do gsettings set org.gnome.settings-daemon.peripherals.keyboard numlock-state on
@@ -53,8 +127,9 @@ def get_numlock_state():
             pass
 
 def main():
-    devices = find_devs(show=False, verbose=False)
-    # print("Found {} devices".format(len(devices)))
+    # Kept up to date by the device monitor, when devices are plugged or
+    # unplugged, or reboot after a firmware update
+    devices = []
 
     root = tk.Tk()
     root.title("QMK Keyboard Control")
@@ -72,22 +147,35 @@ def main():
     tabControl.add(tab2, text="Advanced")
     tabControl.pack(expand=1, fill="both")
 
+    # Moves while devices are being talked to in the background
+    global dispatcher
+    progress = ttk.Progressbar(root, mode="indeterminate")
+    progress.pack(side=tk.BOTTOM, fill="x")
+    dispatcher = TkDispatcher(root, progress)
+
     # Device Checkboxes
     detected_devices_frame = ttk.LabelFrame(tab1, text="Detected Devices", style="TLabelframe")
     detected_devices_frame.pack(fill="x", padx=10, pady=5)
 
     global device_checkboxes
     device_checkboxes = {}
-    for dev in devices:
-        device_info = "{}\nSerial No: {}\nFW Version: {}\n".format(
-            dev['product_string'],
-            dev['serial_number'],
-            format_fw_ver(dev['release_number'])
-        )
-        checkbox_var = tk.BooleanVar(value=True)
-        checkbox = ttk.Checkbutton(detected_devices_frame, text=device_info, variable=checkbox_var, style="TCheckbutton")
-        checkbox.pack(anchor="w")
-        device_checkboxes[dev['path']] = (checkbox_var, checkbox)
+
+    def devices_added(added):
+        devices.extend(added)
+        add_device_checkboxes(detected_devices_frame, added)
+        # Show what the keyboard is currently set to, not the defaults
+        dispatcher.run_on_devices(added, snapshot, show_snapshot)
+
+    def devices_removed(removed):
+        paths = [dev['path'] for dev in removed]
+        devices[:] = [dev for dev in devices if dev['path'] not in paths]
+        remove_device_checkboxes(removed)
+
+    monitor = DeviceMonitor(
+        on_added=lambda added: dispatcher.call_soon(devices_added, added),
+        on_removed=lambda removed: dispatcher.call_soon(devices_removed, removed),
+    )
+    monitor.start()
 
     # Online Info
     info_frame = ttk.LabelFrame(tab1, text="Online Info", style="TLabelframe")
@@ -121,7 +209,7 @@ def main():
     brightness_frame = ttk.LabelFrame(tab1, text="Brightness", style="TLabelframe")
     brightness_frame.pack(fill="x", padx=10, pady=5)
     global brightness_scale
-    brightness_scale = tk.Scale(brightness_frame, from_=0, to=255, orient='horizontal', command=lambda value: perform_action(devices, 'brightness', value=int(value)))
+    brightness_scale = tk.Scale(brightness_frame, from_=0, to=255, orient='horizontal', command=lambda value: brightness_moved(devices, int(value)))
     brightness_scale.set(120)  # Default value
     brightness_scale.pack(fill="x", padx=5, pady=5)
 
@@ -142,6 +230,7 @@ def main():
     # RGB Effect Combo Box
     rgb_effect_label = tk.Label(brightness_frame, text="RGB Effect")
     rgb_effect_label.pack(side=tk.LEFT, padx=5, pady=5)
+    global rgb_effect_combo
     rgb_effect_combo = ttk.Combobox(brightness_frame, values=RGB_EFFECTS, style="TCombobox", state="readonly")
     rgb_effect_combo.pack(side=tk.LEFT, padx=5, pady=5)
     rgb_effect_combo.bind("<<ComboboxSelected>>", lambda event: perform_action(devices, 'rgb_effect', value=RGB_EFFECTS.index(rgb_effect_combo.get())))
@@ -195,17 +284,31 @@ def main():
         ttk.Button(registry_frame, text="Enable Selective Suspend", command=lambda dev: selective_suspend_wrapper(dev, True), style="TButton", state=tk.DISABLED).pack(side="left", padx=5, pady=5)
         toggle_btn = ttk.Button(registry_frame, text="Disable Selective Suspend", command=lambda dev: selective_suspend_wrapper(dev, False), style="TButton", state=tk.DISABLED).pack(side="left", padx=5, pady=5)
 
+    # Looking for firmware releases takes a while, only do it when needed
+    def fw_update_tab_selected(_event):
+        if tabControl.select() == str(tab_fw_update) and not tab_fw_update.winfo_children():
+            fill_fw_update_tab(tab_fw_update, devices)
+    tabControl.bind("<<NotebookTabChanged>>", fw_update_tab_selected)
+
+    program_ver_label = tk.Label(tab1, text=f"Program Version: {PROGRAM_VERSION}")
+    program_ver_label.pack(side=tk.LEFT, padx=5, pady=5)
+
+    root.mainloop()
+
+def fill_fw_update_tab(tab, devices):
+    from qmk_hid import firmware_update
+
     # Only in the pyinstaller bundle are the FW update binaries included
     releases = firmware_update.find_releases(resource_path(), r'framework_(.*)_default.*\.uf2')
     if not releases:
-        tk.Label(tab_fw_update, text="Cannot find firmware updates").pack(side="top", padx=5, pady=5)
+        tk.Label(tab, text="Cannot find firmware updates").pack(side="top", padx=5, pady=5)
     else:
         versions = sorted(list(releases.keys()), reverse=True)
 
         flash_btn = None
         fw_type_combo = None
 
-        fw_update_frame = ttk.LabelFrame(tab_fw_update, text="Update Firmware", style="TLabelframe")
+        fw_update_frame = ttk.LabelFrame(tab, text="Update Firmware", style="TLabelframe")
         fw_update_frame.pack(fill="x", padx=5, pady=5)
         #tk.Label(fw_update_frame, text="Ignore user configured keymap").pack(side="top", padx=5, pady=5)
         fw_ver_combo = ttk.Combobox(fw_update_frame, values=versions, style="TCombobox", state="readonly")
@@ -215,13 +318,34 @@ def main():
         fw_type_combo = ttk.Combobox(fw_update_frame, values=list(releases[versions[0]]), style="TCombobox", state="readonly")
         fw_type_combo.pack(side=tk.LEFT, padx=5, pady=5)
         fw_type_combo.bind("<<ComboboxSelected>>", lambda event: select_fw_type(fw_type_combo.get(), flash_btn))
-        flash_btn = ttk.Button(fw_update_frame, text="Update", command=lambda: tk_flash_firmware(devices, releases, fw_ver_combo.get(), fw_type_combo.get()), state=tk.DISABLED, style="TButton")
+        force_var = tk.BooleanVar(value=False)
+        flash_btn = ttk.Button(fw_update_frame, text="Update", command=lambda: tk_flash_firmware(devices, releases, fw_ver_combo.get(), fw_type_combo.get(), flash_status, force_var.get()), state=tk.DISABLED, style="TButton")
         flash_btn.pack(side="left", padx=5, pady=5)
+        force_checkbox = ttk.Checkbutton(fw_update_frame, text="Also if up to date", variable=force_var, style="TCheckbutton")
+        force_checkbox.pack(side="left", padx=5, pady=5)
+        flash_status = tk.Label(tab, text="", justify=tk.LEFT)
+        flash_status.pack(side="top", anchor="w", padx=5, pady=5)
 
-    program_ver_label = tk.Label(tab1, text=f"Program Version: {PROGRAM_VERSION}")
-    program_ver_label.pack(side=tk.LEFT, padx=5, pady=5)
 
-    root.mainloop()
+def add_device_checkboxes(frame, devs):
+    for dev in devs:
+        device_info = "{}\nSerial No: {}\nFW Version: {}\n".format(
+            dev['product_string'],
+            dev['serial_number'],
+            format_fw_ver(dev['release_number'])
+        )
+        checkbox_var = tk.BooleanVar(value=True)
+        checkbox = ttk.Checkbutton(frame, text=device_info, variable=checkbox_var, style="TCheckbutton")
+        checkbox.pack(anchor="w")
+        device_checkboxes[dev['path']] = (checkbox_var, checkbox)
+
+
+def remove_device_checkboxes(devs):
+    for dev in devs:
+        if dev['path'] in device_checkboxes:
+            (_checkbox_var, checkbox) = device_checkboxes.pop(dev['path'])
+            checkbox.destroy()
+
 
 def update_numlock_state(state_var, refresh_btn=None, toggle_btn=None):
     numlock_on = get_numlock_state()
@@ -237,12 +361,20 @@ def update_numlock_state(state_var, refresh_btn=None, toggle_btn=None):
 
 def toggle_numlock():
     if os.name == 'nt':
+        from win32api import keybd_event
+        from win32con import VK_NUMLOCK
         keybd_event(VK_NUMLOCK, 0x3A, 0x1, 0)
         keybd_event(VK_NUMLOCK, 0x3A, 0x3, 0)
     else:
+        import subprocess
         out = subprocess.check_output(['numlockx', 'toggle'])
 
 
+def open_browser_func(url):
+    import webbrowser
+    webbrowser.open(url)
+
+
 def is_pyinstaller():
     return getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS')
 
@@ -262,6 +394,8 @@ def backlight_watcher(window, devs):
     prev_brightness = {}
     while True:
         for dev in devs:
+            # Brightness can be changed on the keyboard, don't trust the cache
+            invalidate_state(dev)
             brightness = get_backlight(dev, BACKLIGHT_VALUE_BRIGHTNESS)
             rgb_brightness = get_rgb_u8(dev, RGB_MATRIX_VALUE_BRIGHTNESS)
 
@@ -291,6 +425,7 @@ def backlight_watcher(window, devs):
                             set_rgb_brightness(other_dev, new_brightness)
                             #time.sleep(1)
                             # Avoid it triggering an update in the other direction
+                            invalidate_state(other_dev)
                             prev_brightness[other_dev['path']] = {
                                 'brightness': get_backlight(other_dev, BACKLIGHT_VALUE_BRIGHTNESS),
                                 'rgb_brightness': get_rgb_u8(other_dev, RGB_MATRIX_VALUE_BRIGHTNESS),
@@ -300,13 +435,6 @@ def backlight_watcher(window, devs):
         time.sleep(1)
 
 
-def restart_hint():
-    parent = tk.Tk()
-    parent.title("Restart Application")
-    message = tk.Message(parent, text="After updating a device,\n restart the application to reload the connections.", width=800)
-    message.pack(padx=20, pady=20)
-    parent.mainloop()
-
 def info_popup(msg):
     parent = tk.Tk()
     parent.title("Info")
@@ -345,6 +473,7 @@ def selective_suspend_registry(pid, verbose, set=None):
     # Additionally
     # SYSTEM\CurrentControlSet\Control\usbflags\32AC00130026\osvc
     # Where 32AC is the VID, 0013 is the PID, 0026 is the bcdDevice (version)
+    import winreg
     long_pid = "{:0>4X}".format(pid)
     aReg = winreg.ConnectRegistry(None, winreg.HKEY_LOCAL_MACHINE)
 
@@ -399,16 +528,48 @@ def selective_suspend_registry(pid, verbose, set=None):
 def disable_devices(devices):
     # Disable checkbox of selected devices
     for dev in devices:
+        if metrics.ENABLED:
+            metrics.record_disabled(dev)
         for path, (checkbox_var, checkbox) in device_checkboxes.items():
             if path == dev['path']:
                 checkbox_var.set(False)
                 checkbox.config(state=tk.DISABLED)
 
-def perform_action(devices, action, value=None):
-    if action == "bootloader":
-        disable_devices(devices)
-        restart_hint()
+# Value the brightness slider was moved to from a device snapshot. The slider
+# reports it like a user change, whenever it gets redrawn next. That can be
+# much later, Tk doesn't redraw it while its tab isn't shown.
+snapshot_brightness = None
+
 
+def brightness_moved(devices, value):
+    global snapshot_brightness
+    # Its echo, or the user moved it in the meantime
+    echo = value == snapshot_brightness
+    snapshot_brightness = None
+    if not echo:
+        perform_action(devices, 'brightness', value=value)
+
+
+def show_snapshot(results):
+    """Set the controls to the values of the first device that was read"""
+    global snapshot_brightness
+    states = [r.result for r in results if r.error is None]
+    if not states:
+        return
+    state = states[0]
+    brightness = state.get('rgb_brightness', state.get('backlight_brightness'))
+    # The slider only reports changes of its value
+    if brightness is not None and brightness != brightness_scale.get():
+        snapshot_brightness = brightness
+        brightness_scale.set(brightness)
+    effect = state.get('rgb_effect')
+    if effect is not None and effect < len(RGB_EFFECTS):
+        rgb_effect_combo.current(effect)
+
+
+def perform_action(devices, action, value=None):
+    # Devices in the bootloader disappear and come back once they reboot.
+    # The device monitor removes and adds their checkboxes.
     if action == "off":
         brightness_scale.set(0)
 
@@ -428,10 +589,20 @@ def perform_action(devices, action, value=None):
         "brightness": lambda dev: set_white_rgb_brightness(dev, value),
         "rgb_effect": lambda dev: set_rgb_u8(dev, RGB_MATRIX_VALUE_EFFECT, value),
     }
+    if action not in action_map:
+        return
     selected_devices = get_selected_devices(devices)
+    # The keyboard may have been changed with its hotkeys or in VIA since
+    # the last action, don't skip writes based on what was cached then
     for dev in selected_devices:
-        if action in action_map:
-            action_map[action](dev)
+        invalidate_state(dev)
+    if action == "brightness":
+        # The slider fires for every intermediate value, only send the latest
+        futures = brightness_coalescer.submit_all(selected_devices, value)
+        pending = [(dev, f) for (dev, f) in zip(selected_devices, futures) if f is not None]
+        dispatcher.track([dev for (dev, _) in pending], [f for (_, f) in pending])
+        return
+    dispatcher.run_on_devices(selected_devices, action_map[action])
 
 def get_selected_devices(devices):
     return [dev for dev in devices if dev['path'] in device_checkboxes and device_checkboxes[dev['path']][0].get()]
@@ -451,16 +622,54 @@ def select_fw_type(_fw_type, flash_btn):
     # Once the user has selected a type, the exact firmware file is known and can be flashed
     flash_btn.config(state=tk.NORMAL)
 
-def tk_flash_firmware(devices, releases, version, fw_type):
+def tk_flash_firmware(devices, releases, version, fw_type, status_label, force=False):
     selected_devices = get_selected_devices(devices)
-    if len(selected_devices) != 1:
-        info_popup('To flash select exactly 1 device.')
+    if not selected_devices:
+        info_popup('To flash select at least 1 device.')
         return
-    dev = selected_devices[0]
-    firmware_update.flash_firmware(dev, releases[version][fw_type])
-    # Disable device that we just flashed
-    disable_devices(devices)
-    restart_hint()
+    fw_path = releases[version][fw_type]
+
+    from qmk_hid import firmware_update
+
+    # Known from the release index, no need to read the image for it
+    sha256 = firmware_update.release_sha256(fw_path)
+
+    # Skip devices that already run this firmware, they'd just reboot
+    progress = {}
+    if not force:
+        for dev in selected_devices:
+            if firmware_update.is_up_to_date(dev, version, fw_type, sha256):
+                progress[dev['path']] = "up to date"
+        selected_devices = [dev for dev in selected_devices if dev['path'] not in progress]
+
+    # Lets all devices jump to the bootloader and copy at the same time
+    mapper = firmware_update.DriveMapper()
+    progress.update({dev['path']: "waiting for bootloader" for dev in selected_devices})
+
+    def show_progress():
+        status_label.config(text="\n".join(
+            "{}: {}".format(path.decode(errors='replace'), state) for (path, state) in progress.items()))
+
+    def copied(dev, written, total):
+        progress[dev['path']] = "{}%".format(written * 100 // total)
+        show_progress()
+
+    def flash(dev):
+        return firmware_update.flash_firmware(dev, fw_path, mapper=mapper, version=version, force=True, sha256=sha256,
+            on_progress=lambda written, total: dispatcher.call_soon(copied, dev, written, total))
+
+    def flashed(results):
+        for r in results:
+            progress[r.dev['path']] = "done" if r.result else "failed"
+        show_progress()
+        # Flashed devices were removed by the device monitor when they jumped
+        # to the bootloader, and may already be back with the new firmware.
+        # Only the ones that failed are left to disable.
+        disable_devices([r.dev for r in results if r.error is None and not r.result])
+
+    show_progress()
+    # Waiting for the bootloader takes seconds, keep the window responsive
+    dispatcher.run_on_devices(selected_devices, flash, flashed)
 
 if __name__ == "__main__":
     main()
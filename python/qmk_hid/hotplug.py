@@ -0,0 +1,220 @@
+import os
+import re
+import sys
+import threading
+import time
+
+from qmk_hid.protocol import FWK_VID, find_devs, close_device, invalidate_state
+
+HIDRAW_CLASS = "/sys/class/hidraw"
+MOUNTINFO = "/proc/self/mountinfo"
+SYSFS_BLOCK = "/sys/dev/block"
+
+# Component of a sysfs path naming a USB port, like 1-4.2
+USB_PORT = re.compile(r"^\d+-\d+(\.\d+)*$")
+
+# How often to look for new drives where there are no mount events
+DRIVE_POLL_INTERVAL = 0.25
+# With mount events, only in case the drive was mounted in another way
+MOUNT_POLL_INTERVAL = 1.0
+
+
+def hidraw_vid(node):
+    """USB vendor ID of a /sys/class/hidraw node, or None if unknown"""
+    try:
+        with open(os.path.join(HIDRAW_CLASS, node, "device", "uevent")) as f:
+            for line in f:
+                # HID_ID=0003:000032AC:00000012
+                if line.startswith("HID_ID="):
+                    return int(line.strip().split(":")[1], 16)
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _usb_port(sysfs_path):
+    """USB port, like 1-4.2, of the device at a sysfs path, or None"""
+    port = None
+    for part in os.path.realpath(sysfs_path).split(os.sep):
+        if USB_PORT.match(part):
+            port = part
+    return port
+
+
+def device_usb_port(dev):
+    """USB port of a HID device, only known on Linux with the hidraw backend"""
+    path = dev['path'].decode(errors='replace') if isinstance(dev['path'], bytes) else dev['path']
+    if not path.startswith("/dev/hidraw"):
+        return None
+    return _usb_port(os.path.join(HIDRAW_CLASS, os.path.basename(path), "device"))
+
+
+def drive_usb_port(drive):
+    """USB port of the mass storage device mounted at drive, only known on Linux"""
+    try:
+        with open(MOUNTINFO) as f:
+            for line in f:
+                # 36 35 8:1 / /media/user/RPI-RP2 rw,relatime - vfat /dev/sda1 rw
+                fields = line.split()
+                mount_point = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[4])
+                if mount_point == drive:
+                    return _usb_port(os.path.join(SYSFS_BLOCK, fields[2]))
+    except (OSError, IndexError):
+        pass
+    return None
+
+
+class DeviceMonitor:
+    """Keep the list of connected devices up to date
+
+    On Linux each poll only lists /sys/class/hidraw. The HID devices are
+    enumerated again only when a node of a Framework device came or went.
+    Elsewhere the VID filtered enumeration is polled.
+
+    on_added and on_removed are called with a list of device dicts, from the
+    monitor thread.
+    """
+
+    def __init__(self, on_added=None, on_removed=None, interval=1.0):
+        self.on_added = on_added
+        self.on_removed = on_removed
+        self.interval = interval
+        self.devices = []
+        self._nodes = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _relevant_change(self):
+        # Without hidraw in sysfs, there's no cheap way to tell
+        if not sys.platform.startswith("linux") or not os.path.isdir(HIDRAW_CLASS):
+            return True
+        nodes = set(os.listdir(HIDRAW_CLASS))
+        if self._nodes is None:
+            self._nodes = {node: hidraw_vid(node) for node in nodes}
+            return True
+        removed = set(self._nodes) - nodes
+        added = nodes - set(self._nodes)
+        changed = FWK_VID in [self._nodes.pop(node) for node in removed]
+        for node in added:
+            self._nodes[node] = hidraw_vid(node)
+            changed = changed or self._nodes[node] == FWK_VID
+        return changed
+
+    def scan(self):
+        """Check for changes once. Returns (added, removed) device lists"""
+        if not self._relevant_change():
+            return ([], [])
+        devices = find_devs(show=False, verbose=False)
+        old_paths = {dev['path'] for dev in self.devices}
+        new_paths = {dev['path'] for dev in devices}
+        added = [dev for dev in devices if dev['path'] not in old_paths]
+        removed = [dev for dev in self.devices if dev['path'] not in new_paths]
+        self.devices = devices
+
+        # A worker may still be reading from the handle of a removed device.
+        # close_device waits for that under the device lock, closing it right
+        # away would free the handle under the read.
+        for dev in removed:
+            close_device(dev)
+            invalidate_state(dev)
+        if removed and self.on_removed:
+            self.on_removed(removed)
+        if added and self.on_added:
+            self.on_added(added)
+        return (added, removed)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.scan()
+
+    def start(self):
+        """Scan once right away, then keep watching in a background thread"""
+        self.scan()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="qmk_hid-hotplug", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+
+def _drive_board_id(drive):
+    from qmk_hid import uf2conv
+    try:
+        return uf2conv.board_id(drive)
+    except (OSError, AttributeError):
+        # Gone again or no Board-ID in INFO_UF2.TXT
+        return None
+
+
+def _open_mount_events():
+    """Poll object that wakes up when the mount table changes, or None"""
+    if not sys.platform.startswith("linux"):
+        return (None, None)
+    import select
+    try:
+        mounts = open(MOUNTINFO)
+    except OSError:
+        return (None, None)
+    poller = select.poll()
+    poller.register(mounts, select.POLLPRI | select.POLLERR)
+    return (mounts, poller)
+
+
+def _wait_for(check, timeout):
+    """Call check until it returns something true or timeout seconds passed
+
+    Returns the last result of check. On Linux check is only called again
+    when the mount table changes, elsewhere it's polled.
+    """
+    deadline = time.monotonic() + timeout
+    (mounts, poller) = _open_mount_events()
+    try:
+        while True:
+            result = check()
+            remaining = deadline - time.monotonic()
+            if result or remaining <= 0:
+                return result
+            if poller is None:
+                time.sleep(min(remaining, DRIVE_POLL_INTERVAL))
+            else:
+                poller.poll(min(remaining, MOUNT_POLL_INTERVAL) * 1000)
+    finally:
+        if mounts is not None:
+            mounts.close()
+
+
+def wait_for_drives(timeout=10.0, board=None, ignore=(), count=1, match=None):
+    """Wait until UF2 bootloader drives are mounted
+
+    Returns the drives not in ignore, with the Board-ID board and for which
+    match(drive) is true, if given, as soon as there are at least count of
+    them. Or whichever there are after timeout seconds.
+
+    On Linux this waits for changes of the mount table, so it returns as soon
+    as the drive is mounted. Elsewhere the drives are polled.
+    """
+    from qmk_hid import uf2conv
+
+    found = []
+
+    def check():
+        drives = [d for d in uf2conv.get_drives() if d not in ignore]
+        if board is not None:
+            drives = [d for d in drives if _drive_board_id(d) == board]
+        if match is not None:
+            drives = [d for d in drives if match(d)]
+        found[:] = drives
+        return len(drives) >= count
+
+    _wait_for(check, timeout)
+    return found
+
+
+def wait_for_drive_removed(drive, timeout=10.0):
+    """Wait until the drive is gone, returns False if it's still there after timeout seconds"""
+    from qmk_hid import uf2conv
+    return _wait_for(lambda: drive not in uf2conv.get_drives(), timeout)
@@ -0,0 +1,194 @@
+"""Optional counters and latency histograms of device communication
+
+Off by default. When disabled, the protocol code only checks ENABLED.
+
+    from qmk_hid import metrics
+    metrics.enable()
+    ...
+    print(metrics.to_prometheus())
+"""
+import threading
+
+ENABLED = False
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+
+COMMAND_NAMES = {
+    0x01: "GET_PROTOCOL_VERSION",
+    0x02: "GET_KEYBOARD_VALUE",
+    0x03: "SET_KEYBOARD_VALUE",
+    0x07: "CUSTOM_SET_VALUE",
+    0x08: "CUSTOM_GET_VALUE",
+    0x09: "CUSTOM_SAVE",
+    0x0A: "EEPROM_RESET",
+    0x0B: "BOOTLOADER_JUMP",
+}
+
+_lock = threading.Lock()
+# (device, command) -> count
+_reports = {}
+# (device, command) -> [count per bucket..., +Inf count, sum]
+_latency = {}
+# (device, kind) -> count
+_errors = {}
+# device -> count
+_opens = {}
+_reconnects = {}
+_disabled = {}
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    with _lock:
+        for d in (_reports, _latency, _errors, _opens, _reconnects, _disabled):
+            d.clear()
+
+
+def device_label(dev):
+    path = dev['path']
+    return path.decode(errors='replace') if isinstance(path, bytes) else str(path)
+
+
+def command_label(message_id):
+    return COMMAND_NAMES.get(message_id, "0x{:02X}".format(message_id))
+
+
+def record_transaction(dev, message_ids, seconds):
+    """Count the reports of a transaction and its latency
+
+    The latency of a transaction is accounted to its first command.
+    """
+    device = device_label(dev)
+    with _lock:
+        for message_id in message_ids:
+            key = (device, command_label(message_id))
+            _reports[key] = _reports.get(key, 0) + 1
+        key = (device, command_label(message_ids[0]))
+        hist = _latency.get(key)
+        if hist is None:
+            hist = [0] * (len(BUCKETS) + 1) + [0.0]
+            _latency[key] = hist
+        for (i, bound) in enumerate(BUCKETS):
+            if seconds <= bound:
+                hist[i] += 1
+                break
+        else:
+            hist[len(BUCKETS)] += 1
+        hist[-1] += seconds
+
+
+def record_error(dev, kind):
+    """kind is one of 'io', 'timeout', 'response'"""
+    key = (device_label(dev), kind)
+    with _lock:
+        _errors[key] = _errors.get(key, 0) + 1
+
+
+def record_open(dev):
+    device = device_label(dev)
+    with _lock:
+        _opens[device] = _opens.get(device, 0) + 1
+
+
+def record_reconnect(dev):
+    """Device was opened again, after its handle was closed because of an error"""
+    device = device_label(dev)
+    with _lock:
+        _reconnects[device] = _reconnects.get(device, 0) + 1
+
+
+def record_disabled(dev):
+    device = device_label(dev)
+    with _lock:
+        _disabled[device] = _disabled.get(device, 0) + 1
+
+
+def snapshot():
+    """All metrics as a dict, keyed by device"""
+    with _lock:
+        devices = {}
+
+        def entry(device):
+            return devices.setdefault(device, {
+                'reports': {},
+                'latency': {},
+                'errors': {},
+                'opens': 0,
+                'reconnects': 0,
+                'disabled': 0,
+            })
+
+        for ((device, command), count) in _reports.items():
+            entry(device)['reports'][command] = count
+        for ((device, command), hist) in _latency.items():
+            entry(device)['latency'][command] = {
+                'buckets': dict(zip([str(b) for b in BUCKETS] + ["+Inf"], hist[:-1])),
+                'count': sum(hist[:-1]),
+                'sum': hist[-1],
+            }
+        for ((device, kind), count) in _errors.items():
+            entry(device)['errors'][kind] = count
+        for (device, count) in _opens.items():
+            entry(device)['opens'] = count
+        for (device, count) in _reconnects.items():
+            entry(device)['reconnects'] = count
+        for (device, count) in _disabled.items():
+            entry(device)['disabled'] = count
+        return devices
+
+
+def to_json():
+    import json
+    return json.dumps(snapshot(), indent=2, sort_keys=True)
+
+
+def _labels(**labels):
+    return ",".join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')) for (k, v) in labels.items())
+
+
+def to_prometheus():
+    """All metrics in the Prometheus text exposition format"""
+    devices = snapshot()
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for (suffix, labels, value) in samples:
+            lines.append("{}{}{{{}}} {}".format(name, suffix, labels, value))
+
+    metric("qmk_hid_reports_total", "counter", "Reports sent to the device",
+           [("", _labels(device=d, command=c), n)
+            for (d, m) in devices.items() for (c, n) in m['reports'].items()])
+
+    samples = []
+    for (d, m) in devices.items():
+        for (c, hist) in m['latency'].items():
+            cumulative = 0
+            for (bound, n) in hist['buckets'].items():
+                cumulative += n
+                samples.append(("_bucket", _labels(device=d, command=c, le=bound), cumulative))
+            samples.append(("_sum", _labels(device=d, command=c), hist['sum']))
+            samples.append(("_count", _labels(device=d, command=c), hist['count']))
+    metric("qmk_hid_transaction_seconds", "histogram", "Time from first write to last response", samples)
+
+    metric("qmk_hid_errors_total", "counter", "Failed attempts to talk to the device",
+           [("", _labels(device=d, kind=k), n)
+            for (d, m) in devices.items() for (k, n) in m['errors'].items()])
+    metric("qmk_hid_opens_total", "counter", "Times the device was opened",
+           [("", _labels(device=d), m['opens']) for (d, m) in devices.items()])
+    metric("qmk_hid_reconnects_total", "counter", "Times the device was reopened after an error",
+           [("", _labels(device=d), m['reconnects']) for (d, m) in devices.items()])
+    metric("qmk_hid_disabled_total", "counter", "Times the device was disabled in the GUI",
+           [("", _labels(device=d), m['disabled']) for (d, m) in devices.items()])
+    return "\n".join(lines) + "\n"
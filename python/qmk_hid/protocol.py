@@ -1,8 +1,13 @@
+import atexit
 import os
-import sys
+import struct
+import threading
+import time
 
 import hid
 
+from qmk_hid import metrics
+
 FWK_VID = 0x32AC
 
 QMK_INTERFACE = 0x01
@@ -26,6 +31,15 @@ CUSTOM_SAVE = 0x09
 EEPROM_RESET = 0x0A
 BOOTLOADER_JUMP = 0x0B
 
+# How long to wait for a response, in milliseconds
+READ_TIMEOUT_MS = 500
+# How often a transaction is tried again after a timeout or I/O error.
+# Worst case a call takes (RETRIES + 1) * READ_TIMEOUT_MS.
+RETRIES = 2
+# Wait before reopening a device after an I/O error, doubled on every retry.
+# A device node that just reappeared after a replug may not be ready yet.
+REOPEN_DELAY = 0.05
+
 CHANNEL_CUSTOM = 0
 CHANNEL_BACKLIGHT = 1
 CHANNEL_RGB_LIGHT = 2
@@ -95,12 +109,40 @@ RGB_EFFECTS = [
     "SOLID_MULTISPLASH",
 ]
 
+class QmkHidError(Exception):
+    """Base class of errors talking to a device"""
+
+    def __init__(self, dev, msg):
+        super().__init__("{} ({})".format(msg, dev['path']))
+        self.dev = dev
+
+
+class DeviceIOError(QmkHidError):
+    """Device couldn't be opened, written to or read from. Likely unplugged"""
+
+
+class DeviceTimeoutError(QmkHidError):
+    """Device didn't respond in time"""
+
+
+class DeviceResponseError(QmkHidError):
+    """Device sent a response that doesn't belong to any request"""
+
+
+def format_fw_ver(fw_ver):
+    fw_ver_major = (fw_ver & 0xFF00) >> 8
+    fw_ver_minor = (fw_ver & 0x00F0) >> 4
+    fw_ver_patch = (fw_ver & 0x000F)
+    return f"{fw_ver_major}.{fw_ver_minor}.{fw_ver_patch}"
+
+
 def find_devs(show, verbose):
     if verbose:
         show = True
 
     devices = []
-    for device_dict in hid.enumerate():
+    # Let hidapi filter by VID, no need to look at every HID device on the system
+    for device_dict in hid.enumerate(FWK_VID):
         vid = device_dict["vendor_id"]
         pid = device_dict["product_id"]
         product = device_dict["product_string"]
@@ -150,33 +192,362 @@ def find_devs(show, verbose):
     return devices
 
 
-def send_message(dev, message_id, msg, out_len):
-    data = [0xFE] * RAW_HID_BUFFER_SIZE
-    data[0] = 0x00 # NULL report ID
-    data[1] = message_id
-
-    if msg:
-        if len(msg) > RAW_HID_BUFFER_SIZE-2:
-            print("Message too big. BUG. Please report")
-            sys.exit(1)
-        for i, x in enumerate(msg):
-            data[2+i] = x
-
-    try:
-        # TODO: Do this somewhere outside
-        h = hid.device()
-        h.open_path(dev['path'])
-        #h.set_nonblocking(0)
-        h.write(data)
-
-        if out_len == 0:
-            return None
-
-        out_data = h.read(out_len+3)
-        return out_data
-    except (IOError, OSError) as ex:
-        disable_devices([dev])
-        debug_print("Error ({}): ".format(dev['path']), ex)
+# Open device handles, keyed by HID path.
+# Opening a device is a full syscall round trip, so keep them open and reuse
+# them for every report sent to the same device.
+_handles = {}
+_handles_lock = threading.Lock()
+# One preallocated report buffer per device, reused for every report
+_report_buffers = {}
+# Held while talking to a device, so that threads sharing its pooled handle
+# and report buffer take turns. Also keeps the handle from being closed
+# while a read on it is still waiting.
+_device_locks = {}
+# Paths whose handle was closed because of an I/O error. Opening them again
+# counts as a reconnect.
+_closed_by_error = set()
+
+
+def device_lock(dev):
+    """threading.Lock of the pooled handle of dev"""
+    with _handles_lock:
+        lock = _device_locks.get(dev['path'])
+        if lock is None:
+            lock = threading.Lock()
+            _device_locks[dev['path']] = lock
+        return lock
+
+
+def open_device(dev):
+    """Return an open hid.device for dev, reusing a pooled handle if there is one"""
+    path = dev['path']
+    with _handles_lock:
+        h = _handles.get(path)
+        if h is None:
+            h = hid.device()
+            h.open_path(path)
+            # Plain reads only drain what's already there. Waiting for
+            # responses always goes through read with a timeout.
+            h.set_nonblocking(1)
+            _handles[path] = h
+            reconnect = path in _closed_by_error
+            _closed_by_error.discard(path)
+            if metrics.ENABLED:
+                metrics.record_open(dev)
+                if reconnect:
+                    metrics.record_reconnect(dev)
+        return h
+
+
+def close_device(dev):
+    """Close the pooled handle of dev. The next report will reopen it
+
+    Waits for a transaction that's using the handle to finish.
+    """
+    with device_lock(dev):
+        with _handles_lock:
+            h = _handles.pop(dev['path'], None)
+            _report_buffers.pop(dev['path'], None)
+            _unread_responses.pop(dev['path'], None)
+            _closed_by_error.discard(dev['path'])
+        if h is not None:
+            h.close()
+
+
+def close_all_devices():
+    with _handles_lock:
+        devices = [{'path': path} for path in _handles]
+    for dev in devices:
+        close_device(dev)
+
+
+atexit.register(close_all_devices)
+
+
+# Unused bytes of a report are filled with 0xFE
+_REPORT_FILL = b"\xFE" * RAW_HID_BUFFER_SIZE
+# Precompiled layout of a whole report, by message length:
+# NULL report ID, command id, message bytes, fill
+_report_structs = {}
+
+
+def _report_struct(msg_len):
+    s = _report_structs.get(msg_len)
+    if s is None:
+        if msg_len > RAW_HID_BUFFER_SIZE-2:
+            raise ValueError("Message too big. BUG. Please report")
+        s = struct.Struct("<BB{}B{}s".format(msg_len, RAW_HID_BUFFER_SIZE - 2 - msg_len))
+        _report_structs[msg_len] = s
+    return s
+
+
+def encode_message(message_id, msg, buf=None):
+    """Encode a report into buf, a bytearray of RAW_HID_BUFFER_SIZE
+
+    A new buffer is allocated if none is given. Returns buf.
+    """
+    if buf is None:
+        buf = bytearray(RAW_HID_BUFFER_SIZE)
+    msg = msg or ()
+    _report_struct(len(msg)).pack_into(buf, 0, 0x00, message_id, *msg, _REPORT_FILL)
+    return buf
+
+
+def report_buffer(dev):
+    buf = _report_buffers.get(dev['path'])
+    if buf is None:
+        buf = bytearray(RAW_HID_BUFFER_SIZE)
+        _report_buffers[dev['path']] = buf
+    return buf
+
+
+# The firmware echoes the request back, with the requested values filled in
+# after the request header. Unknown commands are answered with 0xFF in place
+# of the command id.
+def response_matches(message_id, msg, response, out_len=0):
+    if len(response) < 1 + len(msg or []) + out_len:
+        return False
+    if response[0] not in (message_id, 0xFF):
+        return False
+    return not msg or response[1:1+len(msg)] == bytes(msg)
+
+
+# Reports left in the input buffer from earlier commands, whose responses
+# nobody waited for, would otherwise be taken for the response of the next.
+# Upper bound, in case the device keeps sending.
+MAX_STALE_REPORTS = 64
+# Number of responses per device that were neither read nor drained yet
+_unread_responses = {}
+
+
+def drain_reports(h):
+    """Throw away all reports already waiting to be read. Returns how many"""
+    for drained in range(MAX_STALE_REPORTS):
+        if not h.read(RAW_HID_BUFFER_SIZE):
+            return drained
+    return MAX_STALE_REPORTS
+
+
+# Last known custom channel values of each device, keyed by HID path and
+# then by (channel, value id). Filled by reads, updated by every successful
+# write, so that reads can be answered and no-op writes skipped without
+# talking to the device.
+# Writes aren't acknowledged, a device without the channel ignores them. So
+# only values that a read showed the device has are updated by writes.
+# Values changed on the device itself (e.g. by brightness hotkeys or in the
+# VIA web app) aren't noticed, so the cache never expires by itself.
+# Long running programs call invalidate_state at the start of every user
+# action, like the GUI, the daemon and qmk_hid.aio do. Otherwise a write
+# of a value the device had cached before is silently skipped.
+STATE_CACHE = True
+_state = {}
+_state_lock = threading.Lock()
+
+
+def invalidate_state(dev=None):
+    """Forget the cached values of dev, or of all devices"""
+    with _state_lock:
+        if dev is None:
+            _state.clear()
+        else:
+            _state.pop(dev['path'], None)
+
+
+def cached_state(dev):
+    """Copy of the cached values of dev: {(channel, value id): (data, ...)}"""
+    with _state_lock:
+        return dict(_state.get(dev['path'], {}))
+
+
+def _update_state(dev, changes):
+    """Apply (key, data, is_read) changes in order
+
+    data None means the device doesn't have the value, a key of None that
+    all values are unknown. Writes only update values that are known.
+    """
+    with _state_lock:
+        state = _state.setdefault(dev['path'], {})
+        for (key, data, is_read) in changes:
+            if key is None:
+                state.clear()
+            elif data is None:
+                state.pop(key, None)
+            elif is_read or key in state:
+                state[key] = data
+
+
+class Transaction:
+    """Several commands for one device, sent back-to-back
+
+    All reports are written first, without waiting for the device in
+    between. Afterwards only the responses that were asked for are read and
+    matched to their request by command id (and channel/value id for reads).
+
+    With use_cache, reads of known values and writes that wouldn't change
+    anything are answered from the state cache and not sent at all.
+    """
+
+    def __init__(self, dev, use_cache=True):
+        self.dev = dev
+        self.use_cache = use_cache and STATE_CACHE
+        self.commands = []
+
+    def add(self, message_id, msg=None, out_len=0):
+        """Queue a command. Returns its index in the result of send()"""
+        if msg and len(msg) > RAW_HID_BUFFER_SIZE-2:
+            raise ValueError("Message too big. BUG. Please report")
+        self.commands.append((message_id, msg, out_len))
+        return len(self.commands) - 1
+
+    def set_value(self, channel, value, *value_data):
+        return self.add(CUSTOM_SET_VALUE, [channel, value, *value_data])
+
+    def get_value(self, channel, value, out_len=1):
+        return self.add(CUSTOM_GET_VALUE, [channel, value], out_len)
+
+    def save(self, channel):
+        return self.add(CUSTOM_SAVE, [channel])
+
+    def send(self, timeout_ms=None, retries=None):
+        """Send all queued commands
+
+        Returns a list with the response of each command as bytes, in the
+        order they were added. Commands that didn't ask for a response get
+        None.
+
+        Waits up to timeout_ms (default READ_TIMEOUT_MS) for the responses and
+        tries the whole transaction up to retries (default RETRIES) more times
+        if that fails. Raises DeviceTimeoutError, DeviceResponseError or
+        DeviceIOError when out of retries.
+        """
+        results = [None] * len(self.commands)
+        to_send = []
+        # What the device state will be after the writes in this transaction
+        known = cached_state(self.dev) if self.use_cache else {}
+        # Written values the device might not have, only to skip repeated
+        # writes. Reads of them have to ask the device.
+        unconfirmed = {}
+        for (i, (message_id, msg, out_len)) in enumerate(self.commands):
+            if message_id == CUSTOM_SET_VALUE:
+                key = (msg[0], msg[1])
+                data = tuple(msg[2:])
+                values = known if key in known else unconfirmed
+                if values.get(key) == data:
+                    continue
+                values[key] = data
+            elif message_id == CUSTOM_GET_VALUE:
+                data = known.get((msg[0], msg[1]))
+                if data is not None and len(data) >= out_len:
+                    results[i] = bytes((message_id, msg[0], msg[1], *data))
+                    continue
+            elif message_id in (EEPROM_RESET, BOOTLOADER_JUMP) and not msg:
+                known = {}
+                unconfirmed = {}
+            to_send.append(i)
+        if not to_send:
+            return results
+
+        read_len = max([self.commands[i][2] for i in to_send]) + 3
+        if timeout_ms is None:
+            timeout_ms = READ_TIMEOUT_MS
+        if retries is None:
+            retries = RETRIES
+        error = None
+
+        # A pooled handle goes stale when the device is unplugged or reboots.
+        # After an I/O error it's dropped and, after a short wait, opened
+        # again, that transparently picks the device back up after a replug.
+        # Timeouts and unexpected responses try again on the same handle.
+        for attempt in range(retries + 1):
+            if attempt and isinstance(error, DeviceIOError):
+                time.sleep(REOPEN_DELAY * 2 ** (attempt - 1))
+            if metrics.ENABLED:
+                start = time.perf_counter()
+            try:
+                with device_lock(self.dev):
+                    self._transfer(to_send, read_len, timeout_ms, results)
+                self._update_state(to_send, results)
+                if metrics.ENABLED:
+                    metrics.record_transaction(self.dev, [self.commands[i][0] for i in to_send], time.perf_counter() - start)
+                return results
+            except (IOError, OSError) as ex:
+                close_device(self.dev)
+                with _handles_lock:
+                    _closed_by_error.add(self.dev['path'])
+                error = DeviceIOError(self.dev, "I/O error: {}".format(ex))
+                if metrics.ENABLED:
+                    metrics.record_error(self.dev, 'io')
+            except DeviceTimeoutError as ex:
+                error = ex
+                if metrics.ENABLED:
+                    metrics.record_error(self.dev, 'timeout')
+            except DeviceResponseError as ex:
+                error = ex
+                if metrics.ENABLED:
+                    metrics.record_error(self.dev, 'response')
+        invalidate_state(self.dev)
+        raise error
+
+    def _transfer(self, sent, read_len, timeout_ms, results):
+        path = self.dev['path']
+        h = open_device(self.dev)
+        # Responses of earlier transactions may still be on their way
+        in_flight = max(0, _unread_responses.get(path, 0) - drain_reports(h))
+        buf = report_buffer(self.dev)
+        for i in sent:
+            (message_id, msg, _) = self.commands[i]
+            # hidapi returns -1 instead of raising
+            if h.write(encode_message(message_id, msg, buf)) < 0:
+                raise IOError(h.error() or "write failed")
+
+        expected = [i for i in sent if self.commands[i][2]]
+        # Echoes of the commands we don't wait for may come in between
+        unexpected_allowed = in_flight + len(sent) - len(expected)
+        deadline = time.monotonic() + timeout_ms / 1000
+        try:
+            while expected:
+                remaining_ms = int((deadline - time.monotonic()) * 1000)
+                # hidapi treats 0 as "wait forever"
+                out_data = bytes(h.read(read_len, remaining_ms)) if remaining_ms > 0 else b""
+                if not out_data:
+                    raise DeviceTimeoutError(self.dev, "No response after {}ms".format(timeout_ms))
+                for i in expected:
+                    (message_id, msg, out_len) = self.commands[i]
+                    if response_matches(message_id, msg, out_data, out_len):
+                        results[i] = out_data
+                        expected.remove(i)
+                        break
+                else:
+                    unexpected_allowed -= 1
+                    if unexpected_allowed < 0:
+                        raise DeviceResponseError(self.dev, "Unexpected response {}".format(out_data[0:3].hex()))
+        finally:
+            # Whatever wasn't read yet may still arrive later
+            _unread_responses[path] = min(MAX_STALE_REPORTS, max(0, unexpected_allowed) + len(expected))
+
+    def _update_state(self, sent, results):
+        if not STATE_CACHE:
+            return
+        changes = []
+        for i in sent:
+            (message_id, msg, out_len) = self.commands[i]
+            if message_id == CUSTOM_SET_VALUE:
+                changes.append(((msg[0], msg[1]), tuple(msg[2:]), False))
+            elif message_id == CUSTOM_GET_VALUE:
+                # 0xFF: the device doesn't have this value
+                data = tuple(results[i][3:3+out_len]) if results[i][0] != 0xFF else None
+                changes.append(((msg[0], msg[1]), data, True))
+            elif message_id in (EEPROM_RESET, BOOTLOADER_JUMP) and not msg:
+                # Settings are back to defaults or the device is gone
+                changes.append((None, None, False))
+        if changes:
+            _update_state(self.dev, changes)
+
+
+def send_message(dev, message_id, msg, out_len, timeout_ms=None):
+    tx = Transaction(dev)
+    tx.add(message_id, msg, out_len)
+    return tx.send(timeout_ms)[0]
 
 def set_keyboard_value(dev, value, number):
     msg = [value, number]
@@ -211,8 +582,10 @@ def set_backlight(dev, value, value_data):
     send_message(dev, CUSTOM_SET_VALUE, msg, 0)
 
 def save(dev):
-    save_rgb(dev)
-    save_backlight(dev)
+    tx = Transaction(dev)
+    tx.save(CHANNEL_RGB_MATRIX)
+    tx.save(CHANNEL_BACKLIGHT)
+    tx.send()
 
 def save_rgb(dev):
     msg = [CHANNEL_RGB_MATRIX]
@@ -228,6 +601,8 @@ def eeprom_reset(dev):
 
 def bootloader_jump(dev):
     send_message(dev, BOOTLOADER_JUMP, None, 0)
+    # Device reboots into the bootloader, the handle won't be valid anymore
+    close_device(dev)
 
 
 def bios_mode(dev, enable):
@@ -252,14 +627,95 @@ def set_white_effect(dev, breathing_on):
 
 # Set both
 def set_white_rgb_brightness(dev, brightness):
-    set_brightness(dev, brightness)
-    set_rgb_brightness(dev, brightness)
+    tx = Transaction(dev)
+    tx.set_value(CHANNEL_BACKLIGHT, BACKLIGHT_VALUE_BRIGHTNESS, brightness)
+    tx.set_value(CHANNEL_RGB_MATRIX, RGB_MATRIX_VALUE_BRIGHTNESS, brightness)
+    tx.send()
 
 
 def set_rgb_color(dev, hue, saturation):
-    (cur_hue, cur_sat) = get_rgb_color(dev)
+    # Only need to ask the device if the hue should stay unchanged
     if hue is None:
-        hue = cur_hue
+        (hue, _cur_sat) = get_rgb_color(dev)
     msg = [CHANNEL_RGB_MATRIX, RGB_MATRIX_VALUE_COLOR, hue, saturation]
     send_message(dev, CUSTOM_SET_VALUE, msg, 0)
 
+
+
+# Lighting values of a snapshot: name, channel, value id, number of bytes
+SNAPSHOT_VALUES = [
+    ("rgb_brightness", CHANNEL_RGB_MATRIX, RGB_MATRIX_VALUE_BRIGHTNESS, 1),
+    ("rgb_effect", CHANNEL_RGB_MATRIX, RGB_MATRIX_VALUE_EFFECT, 1),
+    ("rgb_effect_speed", CHANNEL_RGB_MATRIX, RGB_MATRIX_VALUE_EFFECT_SPEED, 1),
+    ("rgb_color", CHANNEL_RGB_MATRIX, RGB_MATRIX_VALUE_COLOR, 2),
+    ("backlight_brightness", CHANNEL_BACKLIGHT, BACKLIGHT_VALUE_BRIGHTNESS, 1),
+    ("backlight_effect", CHANNEL_BACKLIGHT, BACKLIGHT_VALUE_EFFECT, 1),
+]
+
+
+def snapshot(dev, use_cache=False):
+    """Read all lighting values of dev in one transaction
+
+    Returns a dict that can be serialized to JSON, for example
+    {"rgb_brightness": 120, "rgb_color": [85, 255], ...}. Values the device
+    doesn't have, like RGB on the white backlight keyboard, are left out.
+
+    By default the device is asked, so changes made on the keyboard itself
+    are seen. With use_cache only the values that aren't cached are read.
+    """
+    tx = Transaction(dev, use_cache)
+    for (_name, channel, value, length) in SNAPSHOT_VALUES:
+        tx.get_value(channel, value, length)
+    state = {}
+    for ((name, _channel, _value, length), output) in zip(SNAPSHOT_VALUES, tx.send()):
+        if output[0] == 0xFF:  # Not supported by this device
+            continue
+        data = list(output[3:3+length])
+        state[name] = data[0] if length == 1 else data
+    return state
+
+
+def _snapshot_data(name, length, value):
+    data = [value] if length == 1 else value
+    if not isinstance(data, (list, tuple)) or len(data) != length \
+            or not all(isinstance(x, int) and 0 <= x <= 255 for x in data):
+        raise ValueError("Invalid {} in snapshot: {!r}".format(name, value))
+    return list(data)
+
+
+def restore(dev, state, save=True, use_cache=False):
+    """Bring dev back to a state returned by snapshot
+
+    Only the values that differ from the current state of the device are
+    sent, followed by one save of both channels, all in one transaction.
+    The current state is read from the device first, unless use_cache
+    trusts the cached values. Values missing from state, or not supported by
+    the device, are left alone.
+
+    Returns the names of the values that were changed. Raises ValueError if
+    state has unknown names or values out of range, before sending anything.
+    """
+    known = {name for (name, _channel, _value, _length) in SNAPSHOT_VALUES}
+    unknown = set(state) - known
+    if unknown:
+        raise ValueError("Unknown values in snapshot: {}".format(", ".join(sorted(unknown))))
+    wanted = {}
+    for (name, _channel, _value, length) in SNAPSHOT_VALUES:
+        if name in state:
+            wanted[name] = _snapshot_data(name, length, state[name])
+
+    current = snapshot(dev, use_cache)
+    # Not through the cache, the comparison is already done here
+    tx = Transaction(dev, use_cache=False)
+    changed = []
+    for (name, channel, value, length) in SNAPSHOT_VALUES:
+        if name not in wanted or name not in current:
+            continue
+        if wanted[name] != _snapshot_data(name, length, current[name]):
+            tx.set_value(channel, value, *wanted[name])
+            changed.append(name)
+    if save:
+        tx.save(CHANNEL_RGB_MATRIX)
+        tx.save(CHANNEL_BACKLIGHT)
+    tx.send()
+    return changed
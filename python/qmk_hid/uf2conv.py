@@ -10,10 +10,10 @@ import sys
 import struct
 import subprocess
 import re
+import mmap
 import os
 import os.path
 import argparse
-import json
 
 # Don't even need -b. hex has this embedded
 # > ./util/uf2conv.py .build/framework_ansi_default.hex -o ansi.uf2 -b 0x10000000 -f rp2040 --convert --blocks-reserved 1
@@ -33,6 +33,9 @@ UF2_MAGIC_START0 = 0x0A324655 # "UF2\n"
 UF2_MAGIC_START1 = 0x9E5D5157 # Randomly selected
 UF2_MAGIC_END    = 0x0AB16F30 # Ditto
 
+_UF2_HEADER = struct.Struct("<IIIIIIII")
+_UF2_FOOTER = struct.Struct("<I")
+
 INFO_FILE = "/INFO_UF2.TXT"
 
 appstartaddr = 0x2000
@@ -40,41 +43,123 @@ familyid = 0x0
 
 
 def is_uf2(buf):
+    if len(buf) < 8:
+        return False
     w = struct.unpack("<II", buf[0:8])
     return w[0] == UF2_MAGIC_START0 and w[1] == UF2_MAGIC_START1
 
+_HEX_CHARS = b":0123456789abcdefABCDEF\r\n"
+
 def is_hex(buf):
-    try:
-        w = buf[0:30].decode("utf-8")
-    except UnicodeDecodeError:
-        return False
-    if w[0] == ':' and re.match(b"^[:0-9a-fA-F\r\n]+$", buf):
-        return True
-    return False
+    # Only a ':' and hex digits, deleting them is much faster than a regex
+    return buf[0:1] == b":" and not buf.translate(None, _HEX_CHARS)
+
+def uf2_blocks(buf):
+    """Yield (offset, header) of every 512 byte block in buf
+
+    The header is unpacked with _UF2_HEADER, the magic isn't checked. buf
+    can be anything that supports the buffer protocol, like an mmap, it's
+    not copied.
+    """
+    view = memoryview(buf).cast("B")
+    unpack_from = _UF2_HEADER.unpack_from
+    for ptr in range(0, len(view) - 511, 512):
+        yield (ptr, unpack_from(view, ptr))
+
+def summarize_uf2(buf):
+    """Summary of the blocks in a UF2 file
+
+    Returns a dict with the number of 'blocks' and of those with bad magic
+    ('bad_blocks') or the NO-flash flag ('noflash_blocks'), all distinct
+    'flags', the 'families' with their number of blocks and address range,
+    the contiguous address 'ranges' and the 'gaps' between them. Families,
+    ranges and gaps are keyed by family ID, None for blocks without one.
+    """
+    summary = {
+        'blocks': 0,
+        'bad_blocks': 0,
+        'noflash_blocks': 0,
+        'flags': set(),
+        'families': {},
+        'ranges': [],
+        'gaps': [],
+    }
+    # Family ID -> index into ranges of its last range
+    last_range = {}
+    for (ptr, hd) in uf2_blocks(buf):
+        summary['blocks'] += 1
+        if hd[0] != UF2_MAGIC_START0 or hd[1] != UF2_MAGIC_START1:
+            summary['bad_blocks'] += 1
+            continue
+        flags = hd[2]
+        summary['flags'].add(flags)
+        if flags & 1:
+            summary['noflash_blocks'] += 1
+            continue
+        (addr, datalen) = (hd[3], hd[4])
+        family = hd[7] if flags & 0x2000 else None
+        info = summary['families'].setdefault(family, {'blocks': 0, 'start': addr, 'end': addr + datalen})
+        info['blocks'] += 1
+        info['start'] = min(info['start'], addr)
+        info['end'] = max(info['end'], addr + datalen)
+
+        i = last_range.get(family)
+        if i is not None and summary['ranges'][i][2] == addr:
+            summary['ranges'][i] = (family, summary['ranges'][i][1], addr + datalen)
+            continue
+        if i is not None and summary['ranges'][i][2] < addr:
+            summary['gaps'].append((family, summary['ranges'][i][2], addr))
+        last_range[family] = len(summary['ranges'])
+        summary['ranges'].append((family, addr, addr + datalen))
+    summary['flags'] = sorted(summary['flags'])
+    return summary
+
+def print_uf2_info(summary):
+    print("--- UF2 File Header Info ---")
+    print("Blocks: {}, {} with bad magic, {} not for flashing".format(
+        summary['blocks'], summary['bad_blocks'], summary['noflash_blocks']))
+    for (family, info) in summary['families'].items():
+        if family is None:
+            print("Without family ID")
+        else:
+            print("Family ID is {:s}, hex value is 0x{:08x}".format(family_name(family), family))
+        print("Target Address is 0x{:08x}".format(info['start']))
+        print("  {} blocks up to 0x{:08x}".format(info['blocks'], info['end']))
+    for (family, start, end) in summary['ranges']:
+        print("Range 0x{:08x} - 0x{:08x}".format(start, end))
+    for (family, start, end) in summary['gaps']:
+        print("Gap   0x{:08x} - 0x{:08x} ({} bytes)".format(start, end, end - start))
+    if len(summary['flags']) == 1:
+        print("All block flag values consistent, 0x{:04x}".format(summary['flags'][0]))
+    else:
+        print("Flags were not all the same: " + ", ".join("0x{:04x}".format(f) for f in summary['flags']))
+    print("----------------------------")
 
 def convert_from_uf2(buf):
+    """Extract the binary from a UF2 file
+
+    Only copies the data of each block once, into a preallocated output.
+    Raises ValueError if the blocks can't be put together.
+    """
     global appstartaddr
     global familyid
-    numblocks = len(buf) // 512
+    view = memoryview(buf).cast("B")
     curraddr = None
     currfamilyid = None
-    families_found = {}
-    prev_flag = None
-    all_flags_same = True
-    outp = []
-    for blockno in range(numblocks):
-        ptr = blockno * 512
-        block = buf[ptr:ptr + 512]
-        hd = struct.unpack(b"<IIIIIIII", block[0:32])
+    families_found = set()
+    # (offset in output, offset in buf, length) of the data to extract
+    chunks = []
+    size = 0
+    for (ptr, hd) in uf2_blocks(view):
         if hd[0] != UF2_MAGIC_START0 or hd[1] != UF2_MAGIC_START1:
-            print("Skipping block at " + ptr + "; bad magic")
+            # Bad magic, not a block
             continue
         if hd[2] & 1:
             # NO-flash flag set; skip block
             continue
         datalen = hd[4]
         if datalen > 476:
-            assert False, "Invalid UF2 data size at " + ptr
+            raise ValueError("Invalid UF2 data size at {}".format(ptr))
         newaddr = hd[3]
         if (hd[2] & 0x2000) and (currfamilyid == None):
             currfamilyid = hd[7]
@@ -83,89 +168,103 @@ def convert_from_uf2(buf):
             curraddr = newaddr
             if familyid == 0x0 or familyid == hd[7]:
                 appstartaddr = newaddr
-        print(f"  flags:      0x{hd[2]:02x}")
-        print(f"  addr:       0x{hd[3]:02x}")
-        print(f"  len:        {hd[4]}")
-        print(f"  block no:   {hd[5]}")
-        print(f"  blocks:     {hd[6]}")
-        print(f"  size/famid: {hd[7]}")
-        print()
         padding = newaddr - curraddr
         if padding < 0:
-            assert False, "Block out of order at " + ptr
+            raise ValueError("Block out of order at {}".format(ptr))
         if padding > 10*1024*1024:
-            assert False, "More than 10M of padding needed at " + ptr
+            raise ValueError("More than 10M of padding needed at {}".format(ptr))
         if padding % 4 != 0:
-            assert False, "Non-word padding size at " + ptr
-        while padding > 0:
-            padding -= 4
-            outp.append(b"\x00\x00\x00\x00")
+            raise ValueError("Non-word padding size at {}".format(ptr))
+        size += padding
         if familyid == 0x0 or ((hd[2] & 0x2000) and familyid == hd[7]):
-            outp.append(block[32 : 32 + datalen])
+            chunks.append((size, ptr + 32, datalen))
+            size += datalen
         curraddr = newaddr + datalen
         if hd[2] & 0x2000:
-            if hd[7] in families_found.keys():
-                if families_found[hd[7]] > newaddr:
-                    families_found[hd[7]] = newaddr
-            else:
-                families_found[hd[7]] = newaddr
-        if prev_flag == None:
-            prev_flag = hd[2]
-        if prev_flag != hd[2]:
-            all_flags_same = False
-        if blockno == (numblocks - 1):
-            print("--- UF2 File Header Info ---")
-            families = load_families()
-            for family_hex in families_found.keys():
-                family_short_name = ""
-                for name, value in families.items():
-                    if value == family_hex:
-                        family_short_name = name
-                print("Family ID is {:s}, hex value is 0x{:08x}".format(family_short_name,family_hex))
-                print("Target Address is 0x{:08x}".format(families_found[family_hex]))
-            if all_flags_same:
-                print("All block flag values consistent, 0x{:04x}".format(hd[2]))
-            else:
-                print("Flags were not all the same")
-            print("----------------------------")
-            if len(families_found) > 1 and familyid == 0x0:
-                outp = []
-                appstartaddr = 0x0
-    return b"".join(outp)
-
-def convert_to_carray(file_content):
+            families_found.add(hd[7])
+    if len(families_found) > 1 and familyid == 0x0:
+        appstartaddr = 0x0
+        return bytearray()
+
+    # Zero-filled, the padding doesn't need to be written
+    outp = bytearray(size)
+    for (offset, ptr, datalen) in chunks:
+        outp[offset:offset + datalen] = view[ptr:ptr + datalen]
+    return outp
+
+def convert_to_carray(file_content, out=None):
     outp = "const unsigned long bindata_len = %d;\n" % len(file_content)
     outp += "const unsigned char bindata[] __attribute__((aligned(16))) = {"
-    for i in range(len(file_content)):
-        if i % 16 == 0:
-            outp += "\n"
-        outp += "0x%02x, " % file_content[i]
-    outp += "\n};\n"
-    return bytes(outp, "utf-8")
-
-def convert_to_uf2(file_content, blocks_reserved=0, blocks_offset=0):
-    global familyid
-    datapadding = b""
-    while len(datapadding) < 512 - 256 - 32 - 4:
-        datapadding += b"\x00\x00\x00\x00"
-    numblocks = (len(file_content) + 255) // 256
-    outp = []
-    for blockno in range(numblocks):
-        ptr = 256 * blockno
-        chunk = file_content[ptr:ptr + 256]
-        flags = 0x0
-        if familyid:
-            flags |= 0x2000
-        hd = struct.pack(b"<IIIIIIII",
-            UF2_MAGIC_START0, UF2_MAGIC_START1,
-            flags, ptr + appstartaddr, 256, blockno + blocks_offset, blocks_offset + blocks_reserved + numblocks, familyid)
-        while len(chunk) < 256:
-            chunk += b"\x00"
-        block = hd + chunk + datapadding + struct.pack(b"<I", UF2_MAGIC_END)
-        assert len(block) == 512
-        outp.append(block)
+    chunks = _carray_chunks(memoryview(file_content).cast("B"))
+    if out is not None:
+        written = out.write(outp.encode("utf-8"))
+        for chunk in chunks:
+            written += out.write(chunk)
+        return written + out.write(b"\n};\n")
+    return outp.encode("utf-8") + b"".join(chunks) + b"\n};\n"
+
+_CARRAY_BYTES = ["0x%02x, " % i for i in range(256)]
+
+def _carray_chunks(data):
+    # STREAM_BLOCKS * 512 bytes of input per chunk, 16 per line, each is 6 characters
+    step = STREAM_BLOCKS * 512
+    for start in range(0, len(data), step):
+        text = "".join(map(_CARRAY_BYTES.__getitem__, data[start:start + step]))
+        yield "".join(["\n" + text[i:i + 16 * 6] for i in range(0, len(text), 16 * 6)]).encode("utf-8")
+
+# Blocks encoded into one buffer before it's written out, when streaming to a file
+STREAM_BLOCKS = 128
+
+_UF2_ZEROS = bytes(256)
+
+def _encode_block(buf, offset, addr, data, blockno, numblocks):
+    # Everything between the payload and the footer must already be zero
+    flags = 0x0
+    if familyid:
+        flags |= 0x2000
+    _UF2_HEADER.pack_into(buf, offset,
+        UF2_MAGIC_START0, UF2_MAGIC_START1,
+        flags, addr, 256, blockno, numblocks, familyid)
+    datalen = len(data)
+    buf[offset + 32:offset + 32 + datalen] = data
+    if datalen < 256:
+        buf[offset + 32 + datalen:offset + 288] = _UF2_ZEROS[datalen:]
+    _UF2_FOOTER.pack_into(buf, offset + 512 - 4, UF2_MAGIC_END)
+
+def _encode_blocks(blocks, numblocks, blocks_reserved=0, blocks_offset=0, out=None):
+    """Encode (address, data) pairs into UF2 blocks
+
+    Without out, all blocks are written into one preallocated bytearray,
+    which is returned. Otherwise they're written to the file object out,
+    STREAM_BLOCKS at a time, and the number of bytes written is returned.
+    """
+    total = blocks_offset + blocks_reserved + numblocks
+    if out is None:
+        buf = bytearray(numblocks * 512)
+        for (blockno, (addr, data)) in enumerate(blocks):
+            _encode_block(buf, blockno * 512, addr, data, blockno + blocks_offset, total)
+        return buf
+
+    buf = bytearray(min(numblocks, STREAM_BLOCKS) * 512)
+    written = 0
+    offset = 0
+    for (blockno, (addr, data)) in enumerate(blocks):
+        _encode_block(buf, offset, addr, data, blockno + blocks_offset, total)
+        offset += 512
+        if offset == len(buf):
+            written += out.write(buf)
+            offset = 0
+    if offset:
+        written += out.write(memoryview(buf)[:offset])
+    return written
+
+def convert_to_uf2(file_content, blocks_reserved=0, blocks_offset=0, out=None):
+    data = memoryview(file_content).cast("B")
+    numblocks = (len(data) + 255) // 256
+    blocks = ((appstartaddr + ptr, data[ptr:ptr + 256]) for ptr in range(0, len(data), 256))
+    res = _encode_blocks(blocks, numblocks, blocks_reserved, blocks_offset, out)
     print(f"Converted to {numblocks} blocks")
-    return b"".join(outp)
+    return res
 
 class Block:
     def __init__(self, addr):
@@ -173,58 +272,73 @@ class Block:
         self.bytes = bytearray(256)
 
     def encode(self, blockno, numblocks, blocks_reserved=0, blocks_offset=0):
-        global familyid
-        flags = 0x0
-        if familyid:
-            flags |= 0x2000
-        hd = struct.pack("<IIIIIIII",
-            UF2_MAGIC_START0, UF2_MAGIC_START1,
-            flags, self.addr, 256, blockno + blocks_offset, blocks_offset + blocks_reserved + numblocks, familyid)
-        hd += self.bytes[0:256]
-        while len(hd) < 512 - 4:
-            hd += b"\x00"
-        hd += struct.pack("<I", UF2_MAGIC_END)
-        return hd
-
-def convert_from_hex_to_uf2(buf, blocks_reserved=0, blocks_offset=0):
-    global appstartaddr
-    appstartaddr = None
+        buf = bytearray(512)
+        _encode_block(buf, 0, self.addr, self.bytes, blockno + blocks_offset, blocks_offset + blocks_reserved + numblocks)
+        return bytes(buf)
+
+def parse_hex(lines):
+    """Yield (address, data) of the data records in Intel HEX lines
+
+    lines can be any iterable of str or bytes lines, like an open file.
+    Raises ValueError if a record is malformed or its checksum is wrong.
+    """
     upper = 0
-    currblock = None
-    blocks = []
-    for line in buf.split('\n'):
-        if line[0] != ":":
+    for (lineno, line) in enumerate(lines, 1):
+        if line[0:1] not in (":", b":"):
             continue
-        i = 1
-        rec = []
-        while i < len(line) - 1:
-            rec.append(int(line[i:i+2], 16))
-            i += 2
+        try:
+            if isinstance(line, str):
+                rec = bytes.fromhex(line[1:])
+            else:
+                rec = bytes.fromhex(line[1:].decode("ascii"))
+        except (ValueError, UnicodeDecodeError):
+            raise ValueError(f"Invalid HEX record on line {lineno}")
+        if len(rec) < 5 or rec[0] != len(rec) - 5:
+            raise ValueError(f"Invalid HEX record length on line {lineno}")
+        if sum(rec) & 0xff:
+            raise ValueError(f"HEX record checksum mismatch on line {lineno}")
         tp = rec[3]
-        if tp == 4:
+        if tp == 0:
+            yield (upper + ((rec[1] << 8) | rec[2]), memoryview(rec)[4:-1])
+        elif tp == 4:
             upper = ((rec[4] << 8) | rec[5]) << 16
         elif tp == 2:
             upper = ((rec[4] << 8) | rec[5]) << 4
         elif tp == 1:
             break
-        elif tp == 0:
-            addr = upper + ((rec[1] << 8) | rec[2])
-            if appstartaddr == None:
-                appstartaddr = addr
-            i = 4
-            while i < len(rec) - 1:
-                if not currblock or currblock.addr & ~0xff != addr & ~0xff:
-                    currblock = Block(addr & ~0xff)
-                    blocks.append(currblock)
-                currblock.bytes[addr & 0xff] = rec[i]
-                addr += 1
-                i += 1
+
+def convert_from_hex_to_uf2(buf, blocks_reserved=0, blocks_offset=0, out=None):
+    """Convert Intel HEX to UF2
+
+    buf is the content of the HEX file as str or bytes, or an iterable of
+    its lines, like the open file, to avoid reading it into memory first.
+    """
+    global appstartaddr
+    appstartaddr = None
+    if isinstance(buf, str):
+        buf = buf.split("\n")
+    elif isinstance(buf, (bytes, bytearray)):
+        buf = buf.split(b"\n")
+    currblock = None
+    blocks = []
+    for (addr, data) in parse_hex(buf):
+        if appstartaddr == None:
+            appstartaddr = addr
+        # Copy the data into 256 byte blocks, a new one whenever it
+        # crosses into a different one than the current
+        ptr = 0
+        while ptr < len(data):
+            if not currblock or currblock.addr != addr & ~0xff:
+                currblock = Block(addr & ~0xff)
+                blocks.append(currblock)
+            offset = addr & 0xff
+            count = min(len(data) - ptr, 256 - offset)
+            currblock.bytes[offset:offset + count] = data[ptr:ptr + count]
+            addr += count
+            ptr += count
     numblocks = len(blocks)
     print(f"Converted to {numblocks} blocks")
-    resfile = b""
-    for i in range(0, numblocks):
-        resfile += blocks[i].encode(i, numblocks, blocks_reserved, blocks_offset)
-    return resfile
+    return _encode_blocks(((b.addr, b.bytes) for b in blocks), numblocks, blocks_reserved, blocks_offset, out)
 
 def to_str(b):
     return b.decode("utf-8")
@@ -246,14 +360,20 @@ def get_drives():
         if sys.platform == "darwin":
             rootpath = "/Volumes"
         elif sys.platform == "linux":
-            tmp = rootpath + "/" + os.environ["USER"]
+            # Not from os.environ["USER"], that isn't always set
+            import getpass
+            user = getpass.getuser()
+            tmp = rootpath + "/" + user
             if os.path.isdir(tmp):
                 rootpath = tmp
-            tmp = "/run" + rootpath + "/" + os.environ["USER"]
+            tmp = "/run" + rootpath + "/" + user
             if os.path.isdir(tmp):
                 rootpath = tmp
-        for d in os.listdir(rootpath):
-            drives.append(os.path.join(rootpath, d))
+        try:
+            for d in os.listdir(rootpath):
+                drives.append(os.path.join(rootpath, d))
+        except FileNotFoundError:
+            pass
 
 
     def has_info(d):
@@ -282,22 +402,62 @@ def write_file(name, buf):
     print("Wrote %d bytes to %s" % (len(buf), name))
 
 
+# Used if uf2families.json isn't next to this file, it isn't shipped with
+# the package. Only the families of common bootloaders.
+FALLBACK_FAMILIES = {
+    "ATMEGA32": 0x16573617,
+    "SAMD21": 0x68ed2b88,
+    "SAMD51": 0x55114460,
+    "NRF52": 0x1b57745f,
+    "NRF52840": 0xada52840,
+    "STM32F1": 0x5ee21072,
+    "STM32F4": 0x57755a57,
+    "ESP32S2": 0xbfdd4eee,
+    "RP2040": 0xe48bff56,
+}
+
+# Name -> ID and ID -> name, loaded on first use
+_families = None
+_family_names = None
+
 def load_families():
+    """Family short name -> ID
+
+    Loaded only once, the dict is shared, don't modify it.
+    """
+    global _families, _family_names
+    if _families is not None:
+        return _families
+
     # The expectation is that the `uf2families.json` file is in the same
     # directory as this script. Make a path that works using `__file__`
     # which contains the full path to this script.
     filename = "uf2families.json"
     pathname = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
-    with open(pathname) as f:
-        raw_families = json.load(f)
-
-    families = {}
-    for family in raw_families:
-        families[family["short_name"]] = int(family["id"], 0)
+    try:
+        with open(pathname) as f:
+            import json
+            raw_families = json.load(f)
+    except FileNotFoundError:
+        families = dict(FALLBACK_FAMILIES)
+    else:
+        families = {}
+        for family in raw_families:
+            families[family["short_name"]] = int(family["id"], 0)
 
+    # Same as a linear search, the last name with an ID wins
+    _family_names = {value: name for (name, value) in families.items()}
+    _families = families
     return families
 
 
+def family_name(family_id):
+    """Short name of the family ID, empty if unknown"""
+    if _family_names is None:
+        load_families()
+    return _family_names.get(family_id, "")
+
+
 def main():
     global appstartaddr, familyid
     def error(msg):
@@ -353,20 +513,30 @@ def main():
         if not args.input:
             error("Need input file")
         with open(args.input, mode='rb') as f:
-            inpbuf = f.read()
-        from_uf2 = is_uf2(inpbuf)
+            from_uf2 = is_uf2(f.read(8))
+            f.seek(0)
+            if from_uf2 and not args.deploy:
+                # Only the headers and the data are read, not copied
+                inpbuf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                inpbuf = f.read()
         ext = "uf2"
         if args.deploy:
             outbuf = inpbuf
-        elif from_uf2 and not args.info:
-            outbuf = convert_from_uf2(inpbuf)
-            ext = "bin"
         elif from_uf2 and args.info:
-            outbuf = ""
-            convert_from_uf2(inpbuf)
-
+            print_uf2_info(summarize_uf2(inpbuf))
+            return
+        elif from_uf2:
+            try:
+                outbuf = convert_from_uf2(inpbuf)
+            except ValueError as ex:
+                error(str(ex))
+            ext = "bin"
         elif is_hex(inpbuf):
-            outbuf = convert_from_hex_to_uf2(inpbuf.decode("utf-8"), blocks_reserved, blocks_offset)
+            try:
+                outbuf = convert_from_hex_to_uf2(inpbuf, blocks_reserved, blocks_offset)
+            except ValueError as ex:
+                error(str(ex))
         elif args.carray:
             outbuf = convert_to_carray(inpbuf)
             ext = "h"
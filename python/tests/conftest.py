@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+# The simulated devices are shared with the benchmarks
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+
+from fake_hid import FakeHid  # noqa: E402
+from qmk_hid import protocol  # noqa: E402
+
+
+@pytest.fixture
+def make_fake(monkeypatch):
+    """Replace hid with simulated devices: make_fake(devices, latency, write_latency, unsupported)
+
+    Latencies are in seconds. Channels in unsupported are answered with 0xFF.
+    Pooled handles and the state cache are cleared afterwards.
+    """
+    def make(devices=1, latency=0.0, write_latency=0.0, unsupported=()):
+        fake = FakeHid(devices=devices, latency=latency, write_latency=write_latency,
+                       enumerate_latency=0, unsupported=unsupported)
+        monkeypatch.setattr(protocol, "hid", fake)
+        return fake
+    yield make
+    protocol.close_all_devices()
+    protocol.invalidate_state()
+
+
+@pytest.fixture
+def fake(make_fake):
+    """One simulated keyboard with all channels, answering right away"""
+    return make_fake()
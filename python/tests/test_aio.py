@@ -0,0 +1,32 @@
+import asyncio
+
+from qmk_hid import aio, protocol
+
+
+def test_write_after_change_on_device_is_sent(fake):
+    (dev,) = protocol.find_devs(show=False, verbose=False)
+    key = (protocol.CHANNEL_RGB_MATRIX, protocol.RGB_MATRIX_VALUE_COLOR)
+
+    async def main():
+        await aio.snapshot(dev)
+        await aio.set_rgb_color(dev, protocol.RED_HUE, 255)
+        # Changed with a hotkey or in VIA, not through this process
+        fake.state[dev['path']][key] = [protocol.BLUE_HUE, 255]
+        reports = fake.reports
+        await aio.set_rgb_color(dev, protocol.RED_HUE, 255)
+        return fake.reports - reports
+
+    assert asyncio.run(main()) == 1
+    assert fake.state[dev['path']][key] == [protocol.RED_HUE, 255]
+
+
+def test_calls_inside_device_lock(fake):
+    (dev,) = protocol.find_devs(show=False, verbose=False)
+
+    async def main():
+        async with aio.device_lock(dev):
+            (hue, saturation) = await aio.get_rgb_color(dev, timeout=1)
+            await aio.set_rgb_color(dev, hue + 10, saturation, timeout=1)
+        return await aio.get_rgb_color(dev, timeout=1)
+
+    assert asyncio.run(asyncio.wait_for(main(), 5)) == (10, 0)
@@ -0,0 +1,39 @@
+import pytest
+
+from qmk_hid import cli
+
+
+@pytest.mark.parametrize("argv", [
+    ["brightness", "300"],
+    ["brightness", "-1"],
+    ["brightness", "bright"],
+    ["effect", "999"],
+    ["effect", "SPARKLE"],
+    ["color", "-5"],
+    ["color", "red", "256"],
+    ["animate", "flash", "--hue", "300"],
+])
+def test_out_of_range_is_usage_error(argv):
+    with pytest.raises(cli.CliError):
+        cli.build_parser().parse_args(argv)
+
+
+def test_values_are_parsed():
+    parser = cli.build_parser()
+    assert parser.parse_args(["brightness", "255"]).value == 255
+    assert parser.parse_args(["brightness", "050"]).value == 50
+    assert parser.parse_args(["effect", "breathing"]).value == 5
+    assert parser.parse_args(["effect", "7"]).value == 7
+    args = parser.parse_args(["color", "blue", "0"])
+    assert (args.hue, args.saturation) == (cli.HUES["blue"], 0)
+    assert parser.parse_args(["color", "0x10"]).hue == 16
+    assert parser.parse_args(["animate", "flash"]).hue == cli.HUES["red"]
+
+
+def test_no_device_io_for_invalid_value(fake, capsys):
+    reports = fake.reports
+    with pytest.raises(SystemExit) as ex:
+        cli.main_cli(["--no-daemon", "brightness", "300"])
+    assert ex.value.code == 2
+    assert "out of range" in capsys.readouterr().err
+    assert fake.reports == reports
@@ -0,0 +1,48 @@
+import threading
+
+import pytest
+
+from qmk_hid import protocol
+
+
+@pytest.fixture
+def slow(make_fake, monkeypatch):
+    """Responses take a while, so that threads overlap. Every call goes to the device"""
+    monkeypatch.setattr(protocol, "STATE_CACHE", False)
+    return make_fake(latency=0.0005, write_latency=0.0001)
+
+
+def test_threads_share_one_device(slow, monkeypatch):
+    # Without retries, a response taken by the wrong thread fails the call
+    monkeypatch.setattr(protocol, "RETRIES", 0)
+    (dev,) = protocol.find_devs(show=False, verbose=False)
+    errors = []
+
+    def hammer(value):
+        try:
+            for _ in range(50):
+                protocol.set_backlight(dev, protocol.BACKLIGHT_VALUE_BRIGHTNESS, value)
+                protocol.get_rgb_color(dev)
+        except protocol.QmkHidError as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=hammer, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+
+
+def test_close_waits_for_transaction(slow):
+    (dev,) = protocol.find_devs(show=False, verbose=False)
+    protocol.get_rgb_color(dev)
+    with protocol.device_lock(dev):
+        closer = threading.Thread(target=protocol.close_device, args=(dev,))
+        closer.start()
+        closer.join(0.05)
+        # Still in use, the handle must stay open
+        assert closer.is_alive()
+        assert dev['path'] in protocol._handles
+    closer.join()
+    assert dev['path'] not in protocol._handles
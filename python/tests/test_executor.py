@@ -0,0 +1,31 @@
+import threading
+
+from qmk_hid.executor import Coalescer, DeviceExecutor
+
+
+def test_coalescer_sends_final_value_after_error():
+    dev = {'path': b'/dev/hidraw0'}
+    started = threading.Event()
+    release = threading.Event()
+    sent = []
+    final = threading.Event()
+
+    def write(dev, value):
+        if value == 1:
+            started.set()
+            release.wait(1)
+            raise OSError("write failed")
+        sent.append(value)
+        final.set()
+
+    executor = DeviceExecutor()
+    coalescer = Coalescer(executor, write, rate=1000)
+    first = coalescer.submit(dev, 1)
+    started.wait(1)
+    # Merged into the running drain
+    assert coalescer.submit(dev, 2) is None
+    release.set()
+    assert isinstance(first.exception(1), OSError)
+    assert final.wait(1)
+    assert sent == [2]
+    executor.shutdown()
@@ -0,0 +1,92 @@
+import os
+import sys
+import threading
+
+import pytest
+
+from qmk_hid import firmware_update
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(firmware_update, "cache_dir", lambda: str(tmp_path))
+    return tmp_path
+
+
+def test_parallel_records_are_all_kept(cache):
+    devices = [{'serial_number': "FRAKDE{:04}".format(i)} for i in range(16)]
+    threads = [threading.Thread(target=firmware_update.record_flashed, args=(dev, "ab" * 32, "0.2.0"))
+               for dev in devices]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    flashed = firmware_update._load_flashed()
+    assert sorted(flashed) == [dev['serial_number'] for dev in devices]
+    assert os.listdir(str(cache)) == ["flashed.json"]
+
+
+FILENAME_FORMAT = r'framework_(.*)_default.*\.uf2'
+
+
+def write_image(res_path, version, board, seed):
+    from qmk_hid import uf2conv
+    uf2conv.appstartaddr = 0x10000000
+    uf2conv.familyid = 0xe48bff56
+    path = res_path / "releases" / version / "framework_{}_default.uf2".format(board)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(uf2conv.convert_to_uf2(bytes([seed]) * 4096))
+    return path
+
+
+@pytest.fixture
+def scans(monkeypatch):
+    scans = []
+    scan = firmware_update._scan_releases
+    monkeypatch.setattr(firmware_update, "_scan_releases", lambda *args: scans.append(args) or scan(*args))
+    return scans
+
+
+def test_rebuilt_image_of_same_size_is_revalidated(cache, tmp_path, scans):
+    res = tmp_path / "res"
+    path = write_image(res, "0.2.0", "ansi", 1)
+    first = firmware_update.release_index(str(res), FILENAME_FORMAT)
+    assert firmware_update.release_index(str(res), FILENAME_FORMAT) == first
+    assert len(scans) == 1
+
+    write_image(res, "0.2.0", "ansi", 2)
+    stat = path.stat()
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    second = firmware_update.release_index(str(res), FILENAME_FORMAT)
+    assert len(scans) == 2
+    assert second[0]['size'] == first[0]['size']
+    assert second[0]['sha256'] != first[0]['sha256']
+
+
+def test_separate_cache_per_releases_directory(cache, tmp_path, scans):
+    write_image(tmp_path / "a", "0.2.0", "ansi", 1)
+    write_image(tmp_path / "b", "0.2.0", "ansi", 2)
+    a = firmware_update.release_index(str(tmp_path / "a"), FILENAME_FORMAT)
+    b = firmware_update.release_index(str(tmp_path / "b"), FILENAME_FORMAT)
+    assert a[0]['sha256'] != b[0]['sha256']
+    assert firmware_update.release_index(str(tmp_path / "a"), FILENAME_FORMAT) == a
+    assert len(scans) == 2
+
+
+def test_bundle_cached_across_launches(cache, tmp_path, scans, monkeypatch):
+    exe = tmp_path / "qmk_gui"
+    exe.write_bytes(b"bundle")
+    monkeypatch.setattr(sys, "frozen", True, raising=False)
+    monkeypatch.setattr(sys, "executable", str(exe))
+    # Every launch extracts to a new directory
+    for launch in ("_MEI1", "_MEI2"):
+        write_image(tmp_path / launch, "0.2.0", "ansi", 1)
+        monkeypatch.setattr(sys, "_MEIPASS", str(tmp_path / launch), raising=False)
+        firmware_update.release_index(str(tmp_path / launch), FILENAME_FORMAT)
+    assert len(scans) == 1
+
+    exe.write_bytes(b"new bundle")
+    write_image(tmp_path / "_MEI3", "0.2.0", "ansi", 1)
+    monkeypatch.setattr(sys, "_MEIPASS", str(tmp_path / "_MEI3"))
+    firmware_update.release_index(str(tmp_path / "_MEI3"), FILENAME_FORMAT)
+    assert len(scans) == 2
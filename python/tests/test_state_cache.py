@@ -0,0 +1,36 @@
+import pytest
+
+from qmk_hid import protocol
+
+
+@pytest.fixture
+def white(make_fake):
+    """White backlight keyboard, without the RGB matrix channel"""
+    return make_fake(unsupported=[protocol.CHANNEL_RGB_MATRIX])
+
+
+def test_write_to_unsupported_value_isnt_cached(white):
+    (dev,) = protocol.find_devs(show=False, verbose=False)
+    assert protocol.get_rgb_u8(dev, protocol.RGB_MATRIX_VALUE_BRIGHTNESS) is None
+    protocol.set_white_rgb_brightness(dev, 77)
+    assert protocol.get_rgb_u8(dev, protocol.RGB_MATRIX_VALUE_BRIGHTNESS) is None
+    assert protocol.get_backlight(dev, protocol.BACKLIGHT_VALUE_BRIGHTNESS) == 77
+    state = protocol.snapshot(dev, use_cache=True)
+    assert "rgb_brightness" not in state
+    assert state["backlight_brightness"] == 77
+
+
+def test_write_before_any_read_isnt_cached(white):
+    (dev,) = protocol.find_devs(show=False, verbose=False)
+    protocol.set_rgb_brightness(dev, 77)
+    assert protocol.get_rgb_u8(dev, protocol.RGB_MATRIX_VALUE_BRIGHTNESS) is None
+
+
+def test_write_to_known_value_is_cached(fake):
+    (dev,) = protocol.find_devs(show=False, verbose=False)
+    assert protocol.get_rgb_u8(dev, protocol.RGB_MATRIX_VALUE_BRIGHTNESS) == 0
+    protocol.set_rgb_brightness(dev, 77)
+    reports = fake.reports
+    assert protocol.get_rgb_u8(dev, protocol.RGB_MATRIX_VALUE_BRIGHTNESS) == 77
+    protocol.set_rgb_brightness(dev, 77)
+    assert fake.reports == reports
@@ -0,0 +1,21 @@
+import pytest
+
+from qmk_hid import protocol
+
+
+def test_failed_write_raises(fake, monkeypatch):
+    monkeypatch.setattr(protocol, "RETRIES", 0)
+    (dev,) = protocol.find_devs(show=False, verbose=False)
+    assert protocol.get_rgb_u8(dev, protocol.RGB_MATRIX_VALUE_BRIGHTNESS) == 0
+    # hidapi returns -1 when a write fails
+    monkeypatch.setattr(protocol.open_device(dev), "write", lambda data: -1)
+    with pytest.raises(protocol.DeviceIOError):
+        protocol.set_rgb_brightness(dev, 77)
+    assert protocol.cached_state(dev) == {}
+
+
+def test_failed_write_is_retried_on_a_new_handle(fake, monkeypatch):
+    (dev,) = protocol.find_devs(show=False, verbose=False)
+    monkeypatch.setattr(protocol.open_device(dev), "write", lambda data: -1)
+    protocol.set_rgb_brightness(dev, 77)
+    assert fake.state[dev['path']][(protocol.CHANNEL_RGB_MATRIX, protocol.RGB_MATRIX_VALUE_BRIGHTNESS)][0] == 77
@@ -0,0 +1,91 @@
+import hashlib
+import io
+
+import pytest
+
+from qmk_hid import uf2conv
+
+DATA = bytes((i * 7 + 3) & 0xff for i in range(1000))
+BASE = 0x10000000
+# SHA-256 of the output of the original converter, for the same input
+UF2_SHA256 = "a4146de4fc73a9bd66b215025c49049c02c94c3b61e6f82e88387b57b0b10a86"
+CARRAY_SHA256 = "ec33458471925c92420e4b82911bb02eceeaa633254b4fc4cdbda1d464928d99"
+
+
+@pytest.fixture(autouse=True)
+def rp2040(monkeypatch):
+    monkeypatch.setattr(uf2conv, "appstartaddr", BASE)
+    monkeypatch.setattr(uf2conv, "familyid", 0xe48bff56)
+
+
+def make_hex(data, base, newline="\n"):
+    """Intel HEX with 16 byte data records and extended linear address records"""
+    lines = []
+    upper = None
+    for ptr in range(0, len(data), 16):
+        addr = base + ptr
+        if (addr >> 16) != upper:
+            upper = addr >> 16
+            rec = bytes([2, 0, 0, 4, upper >> 8, upper & 0xff])
+            lines.append(":" + (rec + bytes([-sum(rec) & 0xff])).hex().upper())
+        chunk = data[ptr:ptr + 16]
+        rec = bytes([len(chunk), (addr >> 8) & 0xff, addr & 0xff, 0]) + chunk
+        lines.append(":" + (rec + bytes([-sum(rec) & 0xff])).hex().upper())
+    lines.append(":00000001FF")
+    return (newline.join(lines) + newline).encode()
+
+
+def sha256(buf):
+    return hashlib.sha256(buf).hexdigest()
+
+
+def test_bin_to_uf2():
+    assert sha256(uf2conv.convert_to_uf2(DATA)) == UF2_SHA256
+
+
+def test_bin_to_uf2_streamed():
+    out = io.BytesIO()
+    written = uf2conv.convert_to_uf2(DATA, out=out)
+    assert written == len(out.getvalue())
+    assert sha256(out.getvalue()) == UF2_SHA256
+
+
+def test_bin_to_carray():
+    assert sha256(uf2conv.convert_to_carray(DATA)) == CARRAY_SHA256
+    out = io.BytesIO()
+    uf2conv.convert_to_carray(DATA, out=out)
+    assert sha256(out.getvalue()) == CARRAY_SHA256
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_hex_to_uf2(newline):
+    hex_buf = make_hex(DATA, BASE, newline)
+    assert sha256(uf2conv.convert_from_hex_to_uf2(hex_buf)) == UF2_SHA256
+    assert sha256(uf2conv.convert_from_hex_to_uf2(hex_buf.decode())) == UF2_SHA256
+    out = io.BytesIO()
+    uf2conv.convert_from_hex_to_uf2(io.BytesIO(hex_buf), out=out)
+    assert sha256(out.getvalue()) == UF2_SHA256
+
+
+def test_uf2_to_bin():
+    uf2_buf = uf2conv.convert_to_uf2(DATA)
+    # The last block is padded with zeros
+    padded = DATA + bytes(1024 - len(DATA))
+    assert bytes(uf2conv.convert_from_uf2(uf2_buf)) == padded
+    assert bytes(uf2conv.convert_from_uf2(memoryview(uf2_buf))) == padded
+
+
+def test_hex_bad_checksum():
+    lines = make_hex(DATA, BASE).decode().splitlines()
+    # Last byte of the first data record
+    lines[1] = lines[1][:-2] + "{:02X}".format(int(lines[1][-2:], 16) ^ 1)
+    with pytest.raises(ValueError, match="line 2"):
+        uf2conv.convert_from_hex_to_uf2("\n".join(lines) + "\n")
+
+
+def test_hex_bad_length():
+    lines = make_hex(DATA, BASE).decode().splitlines()
+    # Record says 16 bytes, only 15 are there
+    lines[1] = lines[1][:-4] + lines[1][-2:]
+    with pytest.raises(ValueError, match="line 2"):
+        uf2conv.convert_from_hex_to_uf2("\n".join(lines) + "\n")